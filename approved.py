@@ -2,12 +2,16 @@
 import csv
 from argparse import ArgumentParser as arg_parser
 import logging
+import sqlite3
+import time
 import praw
 
 AGENT = 'python:approved:0.1 (by /u/timendum)'
 
 LOGGER = logging.getLogger(__file__)
 
+SNAPSHOT_DB = 'reddit.db'
+
 class CustomDialect(csv.Dialect):
     """Describe the usual properties of Excel-generated CSV files."""
     delimiter = ';'
@@ -17,24 +21,99 @@ class CustomDialect(csv.Dialect):
     lineterminator = '\r\n'
     quoting = csv.QUOTE_MINIMAL
 
-def process(subreddit: str) -> str:
-    """Read users and add info to the csv"""
+def open_snapshot() -> sqlite3.Connection:
+    """Open the snapshot store of the contributor lists"""
+    con = sqlite3.connect(SNAPSHOT_DB)
+    # removed is NULL while the user is approved
+    con.execute(
+        """CREATE TABLE IF NOT EXISTS approved (
+        subreddit VARCHAR(100) NOT NULL,
+        name VARCHAR(100) NOT NULL,
+        added INTEGER NOT NULL,
+        removed INTEGER,
+        PRIMARY KEY (subreddit, name)
+        )""")
+    con.commit()
+    return con
+
+def diff(previous, current):
+    """Merge two sorted iterables of names, yield (name, change)
+
+    change is 'added' for names only in current,
+    'removed' for names only in previous.
+    """
+    previous = iter(previous)
+    current = iter(current)
+    old = next(previous, None)
+    new = next(current, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old < new):
+            yield old, 'removed'
+            old = next(previous, None)
+        elif old is None or new < old:
+            yield new, 'added'
+            new = next(current, None)
+        else:
+            old = next(previous, None)
+            new = next(current, None)
+
+def process(subreddit: str, full: bool = False) -> list:
+    """Update the snapshot, write the changes and, if full, the whole list"""
     reddit = praw.Reddit(check_for_updates=False, user_agent=AGENT)
     subr = reddit.subreddit(subreddit)
-    contributors = subr.contributor(limit=None)
+    now = int(time.time())
+    # name -> approval date, in listing order
+    contributors = {}
+    for contributor in subr.contributor(limit=None):
+        contributors[contributor.name] = int(getattr(contributor, 'date', now))
+    LOGGER.info('Found %d approved users', len(contributors))
 
-    filename = '%s-approved.csv' % subreddit
-    with open(filename, 'w', newline='', encoding='utf-8') as f:
+    con = open_snapshot()
+    previous = (row[0] for row in con.execute(
+        """SELECT name FROM approved WHERE subreddit = ? AND removed IS NULL
+        ORDER BY name""", (subreddit,)))
+    changes = list(diff(previous, sorted(contributors)))
+    LOGGER.info('Found %d changes', len(changes))
+    for name, change in changes:
+        if change == 'added':
+            con.execute(
+                """INSERT INTO approved (subreddit, name, added) VALUES (?, ?, ?)
+                ON CONFLICT (subreddit, name) DO UPDATE SET
+                added = excluded.added, removed = NULL""",
+                (subreddit, name, contributors[name]))
+        else:
+            con.execute(
+                'UPDATE approved SET removed = ? WHERE subreddit = ? AND name = ?',
+                (now, subreddit, name))
+
+    files = []
+    filename = '%s-approved-changes.csv' % subreddit
+    with open(filename, 'a', newline='', encoding='utf-8') as f:
         writer = csv.writer(f, dialect=CustomDialect)
-        for contributor in contributors:
-            writer.writerow([contributor.name])
-    return filename
+        for name, change in changes:
+            writer.writerow([now, change, name])
+    files.append(filename)
+    con.commit()
+    con.close()
+
+    if full:
+        filename = '%s-approved.csv' % subreddit
+        with open(filename, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, dialect=CustomDialect)
+            for name in contributors:
+                writer.writerow([name])
+        files.append(filename)
+    return files
 
 def main():
     """Provide the entry point to the approved command."""
     parser = arg_parser(usage='usage: %(prog)s [options] SUBREDDIT')
     parser.add_argument(
         'subreddit', type=str, help='The subreddit to be analyzed')
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='Write also the whole list of approved users')
     parser.add_argument(
         '--verbose',
         type=int,
@@ -49,7 +128,7 @@ def main():
     else:
         LOGGER.setLevel(logging.NOTSET)
     LOGGER.addHandler(logging.StreamHandler())
-    process(options.subreddit)
+    process(options.subreddit, options.full)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,162 @@
+"""Serve the archive of subreddit-sql.py as a read-only JSON api."""
+from argparse import ArgumentParser as arg_parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+import hashlib
+import json
+import logging
+import time
+
+from subreddit_archive import Archive, clamp
+
+LOGGER = logging.getLogger(__file__)
+
+SECONDS_IN_DAY = 60 * 60 * 24
+
+# path -> (method, tables of the etag)
+ROUTES = {
+    "submissions": ("get_submissions", ("submissions",)),
+    "comments": ("get_comments", ("comments",)),
+    "top-comments": ("get_top_comments", ("submissions", "comments")),
+    "flairs": ("get_flairs", ("submissions",)),
+    "search": ("get_search", ("submissions",)),
+    "thread": ("get_thread", ("submissions", "comments")),
+    "author": ("get_author", ("submissions", "comments", "authors")),
+}
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """Answer the GET requests with the queries of the archive.
+
+    Every response has an ETag from the version of the tables it reads:
+    a request with the same If-None-Match gets 304 without any query.
+    Archives without versions get no ETag.
+    """
+
+    archive = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        if parts[0] not in ROUTES:
+            self.send_json(404, {"error": "Not found"})
+            return
+        method, tables = ROUTES[parts[0]]
+        self.params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        watermark = self.archive.watermark(tables)
+        etag = None
+        if watermark is not None:
+            etag = '"%s"' % hashlib.sha1(repr((self.path, watermark)).encode()).hexdigest()
+        if etag and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        try:
+            result = getattr(self, method)(*parts[1:])
+        except (TypeError, ValueError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        if result is None:
+            self.send_json(404, {"error": "Not found"})
+            return
+        self.send_json(200, result, etag)
+
+    def send_json(self, status, data, etag=None):
+        body = json.dumps(data, default=vars).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.info("%s - %s", self.address_string(), format % args)
+
+    def window(self) -> tuple[int, int]:
+        """Return the since and until parameters, by default the last day."""
+        until = int(self.params.get("until", time.time()))
+        return int(self.params.get("since", until - SECONDS_IN_DAY)), until
+
+    def limit(self, default=100) -> int:
+        """Return the limit parameter, within 1 and PAGE_LIMIT."""
+        value = self.params.get("limit", default)
+        try:
+            return clamp(int(value))
+        except ValueError:
+            raise ValueError("Invalid limit: %s" % value) from None
+
+    def get_submissions(self):
+        rows, cursor = self.archive.submissions(
+            *self.window(), self.limit(), self.params.get("cursor")
+        )
+        return {"data": rows, "next": cursor}
+
+    def get_comments(self):
+        rows, cursor = self.archive.comments(*self.window(), self.limit(), self.params.get("cursor"))
+        return {"data": rows, "next": cursor}
+
+    def get_top_comments(self):
+        return {
+            "data": self.archive.top_comments(
+                *self.window(), self.limit(), int(self.params.get("min_score", 0))
+            )
+        }
+
+    def get_flairs(self):
+        return {"data": self.archive.flair_leaders(*self.window(), self.limit(10))}
+
+    def get_search(self):
+        if not self.params.get("q"):
+            raise ValueError("Missing q")
+        rows, cursor = self.archive.search(
+            self.params["q"], self.limit(), self.params.get("cursor")
+        )
+        return {"data": rows, "next": cursor}
+
+    def get_thread(self, submission_id):
+        return self.archive.thread(submission_id)
+
+    def get_author(self, name):
+        stats = self.archive.author_stats(name)
+        if stats is None:
+            return None
+        return {"stats": stats, "history": self.archive.author_history(name, self.limit())}
+
+
+def main() -> int:
+    """Provide the entry point to the archive_server command."""
+    parser = arg_parser()
+    parser.add_argument("subreddit", type=str, help="The subreddit of the SUBREDDIT.db archive")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument(
+        "--connections", type=int, default=4, help="Read-only connections to the archive"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0, help="Verbose level"
+    )
+    options = parser.parse_args()
+
+    try:
+        LOGGER.setLevel([logging.NOTSET, logging.INFO, logging.DEBUG][options.verbose])
+    except IndexError:
+        LOGGER.setLevel(logging.DEBUG)
+    LOGGER.addHandler(logging.StreamHandler())
+
+    ArchiveHandler.archive = Archive(options.subreddit, connections=options.connections)
+    server = ThreadingHTTPServer((options.host, options.port), ArchiveHandler)
+    LOGGER.info("Serving %s.db on %s:%d", options.subreddit, options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    ArchiveHandler.archive.close()
+    return 0
+
+
+if __name__ == "__main__":
+    main()
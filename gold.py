@@ -1,11 +1,14 @@
 """Utility to extract gilded in a subreddit."""
 import csv
 import logging
+import sqlite3
 import time
 from argparse import ArgumentParser as arg_parser
 from praw import Reddit
 from praw.models import Comment
 
+from subreddit_archive import namespace_factory
+
 AGENT = 'python:reddit-stats:0.1 (by /u/timendum)'
 
 LOGGER = logging.getLogger(__file__)
@@ -21,15 +24,39 @@ class CustomDialect(csv.Dialect):
     quoting = csv.QUOTE_MINIMAL
 
 
+DB_SUBMISSIONS = """SELECT s.id,
+    (SELECT name FROM authors WHERE authors.id = s.author_id) AS author, s.score,
+    s.permalink, s.created_utc, s.distinguished, SUM(a.count) AS gilded
+FROM submissions AS s JOIN submissions_awards AS a ON a.submission_id = s.id
+GROUP BY s.id ORDER BY s.created_utc DESC"""
+
+DB_COMMENTS = """SELECT c.id,
+    (SELECT name FROM authors WHERE authors.id = c.author_id) AS author, c.score,
+    '/comments/' || c.submission_id || '/_/' || c.id || '/' AS permalink,
+    't3_' || c.submission_id AS link_id, c.created_utc, c.distinguished,
+    SUM(a.count) AS gilded
+FROM comments AS c JOIN comments_awards AS a ON a.comment_id = c.id
+GROUP BY c.id ORDER BY c.created_utc DESC"""
+
+
 class SubredditStats(object):
     """Contain all the functionality of the subreddit_stats command."""
 
-    def __init__(self, subreddit):
+    def __init__(self, subreddit, from_db=False):
         """Initialize the SubredditStats instance with config options."""
         self.comments = []
         self.submissions = []
-        self.reddit = Reddit(check_for_updates=False, user_agent=AGENT)
-        self.subreddit = self.reddit.subreddit(subreddit)
+        if from_db:
+            # read the archive of subreddit-sql.py, no API calls
+            self.reddit = None
+            self.subreddit = subreddit
+            self.con = sqlite3.connect('file:%s.db?mode=ro' % subreddit,
+                                       uri=True)
+            self.con.row_factory = namespace_factory
+        else:
+            self.con = None
+            self.reddit = Reddit(check_for_updates=False, user_agent=AGENT)
+            self.subreddit = self.reddit.subreddit(subreddit)
 
     def fetch_gold(self):
         """Fetch recent glided content.
@@ -40,6 +67,11 @@ class SubredditStats(object):
             else:
                 self.submissions.append(gilded)
 
+    def fetch_db_gold(self):
+        """Fetch awarded content from the archive."""
+        self.submissions.extend(self.con.execute(DB_SUBMISSIONS))
+        self.comments.extend(self.con.execute(DB_COMMENTS))
+
     def process_gilded(self):
         """Write gilded file."""
         filename = '%s-gilded.csv' % self.base_filename
@@ -57,8 +89,9 @@ class SubredditStats(object):
                 ])
             for c in self.comments:
                 writer.writerow([
-                    c.id, c.author, c.score, c.permalink(fast=True), c.link_id,
-                    c.created_utc, c.distinguished, c.gilded
+                    c.id, c.author, c.score,
+                    c.permalink(fast=True) if isinstance(c, Comment) else c.permalink,
+                    c.link_id, c.created_utc, c.distinguished, c.gilded
                 ])
         return filename
 
@@ -67,7 +100,10 @@ class SubredditStats(object):
         LOGGER.info('Analyzing subreddit: %s', self.subreddit)
         self.base_filename = '%s-%d' % (str(self.subreddit), time.time())
 
-        self.fetch_gold()
+        if self.con:
+            self.fetch_db_gold()
+        else:
+            self.fetch_gold()
 
         if not self.comments and not self.submissions:
             LOGGER.warning('No submissions were found.')
@@ -86,6 +122,10 @@ def main():
         type=int,
         default=0,
         help='0 for disabled, 1 for info, more for debug')
+    parser.add_argument(
+        '--from-db',
+        action='store_true',
+        help='Read from the SUBREDDIT.db archive of subreddit-sql.py')
 
     options = parser.parse_args()
 
@@ -97,7 +137,7 @@ def main():
         LOGGER.setLevel(logging.NOTSET)
     LOGGER.addHandler(logging.StreamHandler())
 
-    srs = SubredditStats(options.subreddit)
+    srs = SubredditStats(options.subreddit, options.from_db)
     files = srs.run()
     if files:
         print('Written files: %s' % ' '.join(files))
@@ -2,6 +2,9 @@
 import datetime
 import logging
 import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import prawcore
 from praw import Reddit
@@ -14,15 +17,54 @@ SPLIT_TEXT = "Subreddit Locali"
 
 ACTIVE_UTC = 45 * 24 * 60 * 60
 
+CACHE_DB = "reddit.db"
+DAY_UTC = 24 * 60 * 60
+# Seconds before a check must be repeated, by status
+STATUS_TTL = {
+    "active": 7 * DAY_UTC,
+    "inactive": DAY_UTC,
+    "forbidden": 7 * DAY_UTC,
+    "notfound": 30 * DAY_UTC,
+    "redirect": 30 * DAY_UTC,
+}
+# Subreddits checked at the same time
+PROBE_WORKERS = 4
+# Subreddits in a single /api/info request
+INFO_CHUNK = 100
+# Types of subreddit whose listings can not be read
+CLOSED_TYPES = {"private", "employees_only", "gold_only"}
+
 
 class MultiredditUpdate(object):
     """Contain all the functionality."""
 
-    def __init__(self, wikipage, reddit):
+    def __init__(self, wikipage, reddit, cache_db=CACHE_DB):
         """Initialize"""
         self.wikipage = wikipage
         self._reddit = reddit
-        self._created_limit = datetime.datetime.now(datetime.UTC).timestamp() - ACTIVE_UTC
+        # a Reddit instance for each probing thread, praw is not thread-safe
+        self._local = threading.local()
+        self._now = datetime.datetime.now(datetime.UTC).timestamp()
+        self._created_limit = self._now - ACTIVE_UTC
+        self._con = sqlite3.connect(cache_db)
+        self._con.execute(
+            """CREATE TABLE IF NOT EXISTS subreddit_activity (
+        subreddit VARCHAR(100) NOT NULL,
+        last_post_utc int,
+        status VARCHAR(20) NOT NULL,
+        checked_at int NOT NULL,
+        PRIMARY KEY (subreddit)
+        )
+"""
+        )
+        self._con.commit()
+        # subreddit -> (last_post_utc, status, checked_at)
+        self._cache = {
+            row[0]: row[1:]
+            for row in self._con.execute(
+                "SELECT subreddit, last_post_utc, status, checked_at FROM subreddit_activity"
+            )
+        }
 
     def _find_and_filter(self, wcontent):
         subs = re.findall(r"r/[0-9A-Za-z_]+", wcontent)
@@ -32,9 +74,74 @@ class MultiredditUpdate(object):
         subs = [
             sub for sub in subs if sub != self.wikipage.subreddit.display_name
         ]  # no r/italy
+        self._check([sub for sub in subs if not self._is_fresh(sub)])
         subs = [sub for sub in subs if self._is_active(sub)]
         return subs
 
+    def _is_fresh(self, subname):
+        """True if the cached state of the subreddit can be trusted"""
+        cached = self._cache.get(subname.lower())
+        if not cached:
+            return False
+        last_post_utc, status, checked_at = cached
+        if status == "active" and last_post_utc <= self._created_limit:
+            # the last post is now too old
+            return False
+        return checked_at + STATUS_TTL[status] > self._now
+
+    def _check(self, subnames):
+        """Probe the subreddits concurrently and cache the results"""
+        closed = self._prefilter(subnames)
+        for subname, status in closed.items():
+            self._save(subname, status, None)
+        subnames = [subname for subname in subnames if subname not in closed]
+        LOGGER.info("Probing %d subreddits", len(subnames))
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+            for subname, (status, last_post_utc) in zip(
+                subnames, executor.map(self._probe, subnames)
+            ):
+                self._save(subname, status, last_post_utc)
+        self._con.commit()
+
+    def _save(self, subname, status, last_post_utc):
+        self._cache[subname.lower()] = (last_post_utc, status, self._now)
+        self._con.execute(
+            """INSERT OR REPLACE INTO subreddit_activity
+        (subreddit, last_post_utc, status, checked_at) VALUES (?, ?, ?, ?)""",
+            (subname.lower(), last_post_utc, status, self._now),
+        )
+
+    def _prefilter(self, subnames):
+        """Return the status of the subreddits that can not be listed.
+
+        Metadata is fetched in bulk, INFO_CHUNK subreddits each request:
+        missing ones do not exist or are banned, private and quarantined
+        ones can not be read.
+        """
+        found = {}
+        try:
+            for start in range(0, len(subnames), INFO_CHUNK):
+                chunk = subnames[start : start + INFO_CHUNK]
+                for rsub in self._reddit.info(subreddits=chunk):
+                    found[rsub.display_name.lower()] = rsub
+        except prawcore.exceptions.PrawcoreException as e:
+            LOGGER.warning("Metadata not available, probing all: %s", e)
+            return {}
+        closed = {}
+        for subname in subnames:
+            rsub = found.get(subname.lower())
+            if rsub is None:
+                LOGGER.info("%s NotFound", subname)
+                closed[subname] = "notfound"
+            elif rsub.subreddit_type in CLOSED_TYPES or getattr(rsub, "quarantine", False):
+                LOGGER.info("%s Forbidden (%s)", subname, rsub.subreddit_type)
+                closed[subname] = "forbidden"
+        return closed
+
+    def _is_active(self, subname):
+        cached = self._cache.get(subname.lower())
+        return bool(cached) and cached[1] == "active" and cached[0] > self._created_limit
+
     def regional(self, multiname):
         wcontent = self.wikipage.content_md
         wcontent = wcontent.split(SPLIT_TEXT)[1]
@@ -79,24 +186,35 @@ Aggiornato: {}""".format(
             ),
         )
 
-    def _is_active(self, subname):
+    def _probe_reddit(self):
+        """Return the Reddit instance of the current probing thread"""
+        if not hasattr(self._local, "reddit"):
+            # same site config of main
+            self._local.reddit = Reddit()
+        return self._local.reddit
+
+    def _probe(self, subname):
+        """Return the status of the subreddit and the time of its last post"""
         try:
-            rsub = self._reddit.subreddit(subname)
+            rsub = self._probe_reddit().subreddit(subname)
             for submission in rsub.new(limit=5):
                 if submission.created_utc > self._created_limit:
                     if submission.author.name == "AutoModerator":
                         LOGGER.debug("Automoderator %s", submission)
                         continue
                     LOGGER.info("%s ok (%s)", subname, submission)
-                    return True
+                    return "active", submission.created_utc
             LOGGER.info("%s skipped", subname)
+            return "inactive", None
         except prawcore.exceptions.NotFound:
             LOGGER.info("%s NotFound", subname)
+            return "notfound", None
         except prawcore.exceptions.Redirect:
             LOGGER.info("%s Redirect", subname)
+            return "redirect", None
         except prawcore.exceptions.Forbidden:
             LOGGER.info("%s Forbidden", subname)
-        return False
+            return "forbidden", None
 
 
 def main():
@@ -1,10 +1,11 @@
 """Produce a summery for AskOuija thread"""
 # pylint: disable=C0103
+import json
 import logging
 import datetime
-from sys import argv
+import time
+from argparse import ArgumentParser as arg_parser
 from praw import Reddit
-from praw.models.comment_forest import CommentForest
 
 AGENT = 'python:reddit-ouja:0.1 (by /u/timendum)'
 
@@ -15,12 +16,46 @@ END = '‡'
 # Print open ansers even if there are closed in the same question
 TODO_ALWAYS = True
 
+CLOSINGS = ('goodbye', 'arrivederci')
+
+# Seconds between two polls of new comments in live mode
+POLL_SECONDS = 10
+
+# Last text of ok and todo, kept between runs
+STATE_FILE = 'ouija-%s.json'
+
+
+class Letter(object):
+    """A node of the answers trie: a reply with a single letter."""
+    __slots__ = ('letter', 'score', 'permalink', 'children', 'closings',
+                 'closed', 'open')
+
+    def __init__(self, letter, score, permalink):
+        self.letter = letter
+        self.score = score
+        self.permalink = permalink
+        self.children = []
+        # closing replies, already formatted
+        self.closings = []
+        # any closing below this node
+        self.closed = False
+        # any open answer from the children
+        self.open = False
+
+    def has_opens(self):
+        """Return True if this node produces open answers."""
+        if self.closed and not TODO_ALWAYS:
+            return False
+        return self.open or (not self.closed and self.score > 0)
+
+
 class Ouija(object):
     """Contain all the functionality of the subreddit_stats command."""
 
     def __init__(self, post_id, ok_id=None, todo_id=None):
         """Initialize."""
         reddit = Reddit(check_for_updates=False)
+        self.reddit = reddit
         self.post = reddit.submission(id=post_id)
         self.ok = None
         self.todo = None
@@ -28,6 +63,75 @@ class Ouija(object):
             self.ok = reddit.comment(id=ok_id)
         if todo_id:
             self.todo = reddit.comment(id=todo_id)
+        # top level comments, by id
+        self.questions = None
+        # replies of each comment, by id
+        self.children = {}
+        # top level comment id of each comment
+        self.root_of = {}
+        # [opens, closeds] of each question, by id
+        self.results = {}
+        # last text of ok and todo, without the header
+        self.state_file = STATE_FILE % post_id
+        self.targets = [ok_id, todo_id]
+        self.rendered = self.load_rendered()
+
+    def load_rendered(self):
+        """Return the last text of ok and todo written by a previous run"""
+        try:
+            with open(self.state_file, encoding='utf8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return [None, None]
+        if state.get('targets') != self.targets:
+            # written to other comments
+            return [None, None]
+        return state['rendered']
+
+    def save_rendered(self):
+        """Keep the last text of ok and todo for the next run"""
+        with open(self.state_file, 'w', encoding='utf8') as f:
+            json.dump({'targets': self.targets, 'rendered': self.rendered}, f)
+
+    def load(self):
+        """Fetch and index the whole comment tree of the post"""
+        if self.questions is not None:
+            # fetch again
+            self.post = self.reddit.submission(id=self.post.id)
+        self.questions = {}
+        self.children = {}
+        self.root_of = {}
+        self.results = {}
+        for question in self.fetch_comments():
+            if question.stickied:
+                # skip stickied comment
+                continue
+            self.questions[question.id] = question
+            stack = [question]
+            while stack:
+                comment = stack.pop()
+                self.root_of[comment.id] = question.id
+                self.children[comment.id] = list(comment.replies)
+                stack.extend(self.children[comment.id])
+
+    def add_comment(self, comment):
+        """Add a new comment to the tree, return True if it was added"""
+        if comment.link_id != self.post.fullname or comment.id in self.root_of:
+            return False
+        parent_id = comment.parent_id[3:]
+        self.children[comment.id] = []
+        if comment.parent_id == comment.link_id:
+            self.root_of[comment.id] = comment.id
+            self.questions[comment.id] = comment
+        elif parent_id in self.root_of:
+            self.children[parent_id].append(comment)
+            self.root_of[comment.id] = self.root_of[parent_id]
+            # the question must be computed again
+            self.results.pop(self.root_of[parent_id], None)
+        else:
+            LOGGER.debug('Unknown parent for %s', comment.id)
+            return False
+        return True
 
     def fetch_comments(self):
         """Return the comment of the post"""
@@ -35,37 +139,62 @@ class Ouija(object):
         self.post.comments.replace_more(limit=None)
         return self.post.comments
 
-    def find_answers(self, parent):
-        """Given a comment return a list of open and closed replies"""
+    def build_trie(self, question):
+        """Return the trie of the letters replied to question."""
+        root = Letter('', question.score, None)
+        nodes = [root]
+        stack = [(question, root)]
+        while stack:
+            parent, node = stack.pop()
+            for comment in self.children[parent.id]:
+                body = comment.body.strip()
+                lower = body.lower()
+                if any(closing in lower for closing in CLOSINGS):
+                    # closing found
+                    if comment.score > 0:
+                        node.closings.append('[%s](%s?context=99) - %d' % (
+                            END, self.permalink(comment), comment.score))
+                elif len(body) == 1:
+                    child = Letter(body, comment.score, self.permalink(comment))
+                    node.children.append(child)
+                    nodes.append(child)
+                    stack.append((comment, child))
+                else:
+                    LOGGER.debug('Skipped %s', comment.body)
+        # children are always after their parent
+        for node in reversed(nodes):
+            node.closed = bool(node.closings) or \
+                any(child.closed for child in node.children)
+            node.open = any(child.has_opens() for child in node.children)
+        return root
+
+    @staticmethod
+    def answers(root):
+        """Given a trie return a list of open and closed answers"""
         closeds = []
         opens = []
-        if isinstance(parent, CommentForest):
-            parent.replace_more(limit=None)
-        for comment in parent.replies:
-            # closing found
-            if 'goodbye' in comment.body.lower() or \
-               'arrivederci' in comment.body.lower():
-                if comment.score > 0:
-                    closeds.append('[%s](%s?context=99) - %d' % (
-                        END, self.permalink(comment), comment.score))
-
-        for comment in parent.replies:
-            body = comment.body.strip()
-            if len(body) == 1:
-                others, oks = self.find_answers(comment)
-                for sub in oks:
-                    closeds.append(body + sub)
-                if not oks or TODO_ALWAYS:
-                    for sub in others:
-                        opens.append(body + sub)
-                    # no descendant and no closed -> last char of an open answer
-                    if not others and not oks:
-                        if comment.score > 0:
-                            opens.append('[%s](%s)' % (body, self.permalink(comment)))
-            else:
-                LOGGER.debug('Skipped %s', comment.body)
+        path = []
+        # node, depth, open answers allowed
+        stack = [(root, 0, True)]
+        while stack:
+            node, depth, todo = stack.pop()
+            del path[depth:]
+            path.append(node.letter)
+            for closing in node.closings:
+                closeds.append(''.join(path) + closing)
+            if todo and node is not root and not node.open and \
+               not node.closed and node.score > 0:
+                # no descendant and no closed -> last char of an open answer
+                opens.append(''.join(path[:-1]) + '[%s](%s)' % (node.letter, node.permalink))
+            for child in reversed(node.children):
+                stack.append((child, depth + 1,
+                              todo and (TODO_ALWAYS or not child.closed)))
         return opens, closeds
 
+    def find_answers(self, question):
+        """Given a comment return a list of open and closed replies"""
+        return self.answers(self.build_trie(question))
+
     def oujas(self):
         """Return a list of [ok, todo]
 
@@ -73,27 +202,27 @@ class Ouija(object):
         todo = list of [question, answer] without ending (Goodbye)
         """
         ok, todo = [], []
-        for comment in self.fetch_comments():
-            if comment.stickied:
-                # skip stickied comment
-                continue
+        if self.questions is None:
+            self.load()
+        for comment_id, comment in self.questions.items():
             question = comment.body
             question = question.split('\n')[0]
-            opens, closeds = self.find_answers(comment)
+            if comment_id not in self.results:
+                self.results[comment_id] = self.find_answers(comment)
+            opens, closeds = self.results[comment_id]
             if closeds:
-                closeds.sort(key=lambda a: int(a.split(' - ')[-1]), reverse=True)
+                closeds = sorted(closeds, key=lambda a: int(a.split(' - ')[-1]),
+                                 reverse=True)
                 ok.append([question, closeds])
             if not closeds or TODO_ALWAYS:
                 if opens:
-                    opens.sort(key=len, reverse=True)
+                    opens = sorted(opens, key=len, reverse=True)
                     todo.append([question, opens])
         return ok, todo
 
-    def text(self):
-        """Produce two string, one for closed and one for open questions."""
+    def render(self):
+        """Produce the text of closed and open questions, without headers."""
         text = ''
-        ora = datetime.datetime.now().strftime('%H:%M')
-        text += 'I Risultati alle %s.  \n%s = Finito - numero dei voti\n\n' % (ora, END)
         ok, todo = self.oujas()
         for ouja in ok:
             text += ouja[0] + '\n\n'
@@ -101,7 +230,7 @@ class Ouija(object):
                 text += '* ' + answer + '\n'
             text += '\n\n'
         a = text
-        text = 'Le domande aperte alle %s.\n\n' % (ora)
+        text = ''
         for ouja in todo:
             text += ouja[0] + '\n\n'
             for answer in ouja[1]:
@@ -110,12 +239,26 @@ class Ouija(object):
         b = text
         return a, b
 
+    def text(self):
+        """Produce two string, one for closed and one for open questions."""
+        ora = datetime.datetime.now().strftime('%H:%M')
+        a, b = self.render()
+        a = 'I Risultati alle %s.  \n%s = Finito - numero dei voti\n\n' % (ora, END) + a
+        b = 'Le domande aperte alle %s.\n\n' % (ora) + b
+        return a, b
+
     def output(self):
-        """Write files or edit comments"""
+        """Write files or edit comments, only if the text changed"""
+        rendered = list(self.render())
+        if rendered == self.rendered:
+            LOGGER.info('Nothing changed')
+            return
+        changed = [new != old for new, old in zip(rendered, self.rendered)]
+        self.rendered = rendered
         ok, todo = self.text()
-        if self.ok:
+        if self.ok and changed[0]:
             self.ok.edit(ok)
-        if self.todo:
+        if self.todo and changed[1]:
             self.todo.edit(todo)
 
         if not self.ok or not self.todo:
@@ -123,17 +266,65 @@ class Ouija(object):
                 f.write(ok)
             with open('todos.txt', 'w', encoding='utf8') as f:
                 f.write(todo)
+        self.save_rendered()
 
     def permalink(self, comment):
         """Produce a shorter permalink"""
         return '/r/{}/comments/{}//{}'.format(self.post.subreddit.display_name,
                                               self.post.id, comment.id)
 
+    def live(self, interval, full_every=0):
+        """Keep the output updated, fetching only the new comments.
 
-if __name__ == "__main__":
-    if len(argv) < 2:
-        print('Invoke the program with post_id')
+        The whole tree is fetched again every full_every updates,
+        to refresh the scores.
+        """
+        stream = self.post.subreddit.stream.comments(pause_after=0,
+                                                     skip_existing=True)
+        # start the stream before loading, duplicates are discarded
+        next(stream)
+        self.load()
+        self.output()
+        updates = 0
+        while True:
+            deadline = time.time() + interval
+            while time.time() < deadline:
+                for comment in stream:
+                    if comment is None:
+                        break
+                    if self.add_comment(comment):
+                        LOGGER.debug('New comment %s', comment.id)
+                time.sleep(POLL_SECONDS)
+            updates += 1
+            if full_every and updates % full_every == 0:
+                self.load()
+            self.output()
+
+
+def main():
+    """Provide the entry point to the command."""
+    parser = arg_parser(usage='usage: %(prog)s [options] post_id [ok_id todo_id]')
+    parser.add_argument('post_id', type=str, help='The AskOuija thread')
+    parser.add_argument(
+        'ok_id', type=str, nargs='?', help='The comment to edit with the results')
+    parser.add_argument(
+        'todo_id', type=str, nargs='?',
+        help='The comment to edit with the open questions')
+    parser.add_argument(
+        '--live', type=int, default=0,
+        help='Keep running, updating every LIVE seconds')
+    parser.add_argument(
+        '--full-every', type=int, default=30,
+        help='In live mode, fetch again the whole thread every N updates '
+        '(0 for never)')
+    options = parser.parse_args()
+
+    o = Ouija(options.post_id, options.ok_id, options.todo_id)
+    if options.live:
+        o.live(options.live, options.full_every)
     else:
-        args = argv + [None, None]
-        o = Ouija(*argv[1:])
         o.output()
+
+
+if __name__ == "__main__":
+    main()
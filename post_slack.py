@@ -1,30 +1,70 @@
 """Post new submission to Slack"""
+import json
 import logging
 import sqlite3
-from sys import argv
+import time
+from argparse import ArgumentParser as arg_parser
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from praw import Reddit
 
 AGENT = "python:post_slack:0.1 (by /u/timendum)"
 
 LOGGER = logging.getLogger(__file__)
 
+# Seconds new submissions are collected before a message is sent
+BATCH_WINDOW = 60
 
-def main(subreddit, hook_url):
+
+def open_db():
     conn = sqlite3.connect("reddit.db")
 
-    # Prepare table
+    # Prepare table, scanned_utc is the newest submission looked at
     conn.execute(
         """CREATE TABLE IF NOT EXISTS post_slack (
         subreddit VARCHAR(100) NOT NULL,
         created_utc int,
+        scanned_utc int,
         PRIMARY KEY (subreddit)
         )
+"""
+    )
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(post_slack)")}
+    if "scanned_utc" not in columns:
+        conn.execute("ALTER TABLE post_slack ADD COLUMN scanned_utc int")
+    # Submissions not yet delivered
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS post_slack_queue (
+        subreddit VARCHAR(100) NOT NULL,
+        id VARCHAR(20) NOT NULL,
+        title TEXT,
+        author VARCHAR(100),
+        created_utc int,
+        PRIMARY KEY (subreddit, id)
+        )
 """
     )
     conn.commit()
-    # Fetch created_utc
+    return conn
+
+
+def slack_session():
+    """Return a keep-alive session, retrying the failed webhook calls"""
+    retry = Retry(
+        total=5,
+        backoff_factor=2,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(max_retries=retry))
+    return session
+
+
+def get_created_utc(conn, subreddit):
+    """Return the created_utc of the latest submission queued"""
     created_utc = 0
     c = conn.cursor()
     c.execute("SELECT created_utc FROM post_slack WHERE subreddit = ?", [subreddit])
@@ -32,39 +72,225 @@ def main(subreddit, hook_url):
     if row:
         created_utc = row[0]
     c.close()
-    LOGGER.debug("Latest created_utc %i", created_utc)
-    reddit = Reddit(check_for_updates=False)
-    rsubreddit = reddit.subreddit(subreddit)
-    new_created_utc = 0
-    for submission in reversed(list(rsubreddit.new(limit=3))):
-        LOGGER.debug("Found %s", submission)
-        if not submission.author or submission.removed:
-            # deleted or removed
-            LOGGER.debug("Skipped: deleted or removed")
+    return created_utc
+
+
+def get_scanned_utc(conn, subreddit):
+    """Return the created_utc of the newest submission looked at"""
+    row = conn.execute(
+        "SELECT COALESCE(scanned_utc, created_utc) FROM post_slack WHERE subreddit = ?",
+        [subreddit],
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def set_scanned_utc(conn, hooks, scanned_utc):
+    """Record that every submission up to scanned_utc was looked at"""
+    conn.executemany(
+        """UPDATE post_slack SET scanned_utc = MAX(COALESCE(scanned_utc, 0), ?)
+        WHERE subreddit = ?""",
+        [(scanned_utc, subreddit) for subreddit in hooks],
+    )
+    conn.commit()
+
+
+def seed(conn, reddit, hooks):
+    """Start the subreddits never followed from their newest post.
+
+    The backlog of a new subreddit is not sent.
+    """
+    for subreddit in hooks:
+        c = conn.execute("SELECT 1 FROM post_slack WHERE subreddit = ?", [subreddit])
+        if c.fetchone():
             continue
-        if submission.created_utc > created_utc:
-            LOGGER.debug("OK: %i", submission.created_utc)
-            new_created_utc = max(new_created_utc, submission.created_utc)
-            r = requests.post(
-                hook_url,
-                data={
-                    "payload": '{{"text": "New post: <https://redd.it/{}|{}> by {}"}}'.format(
-                        submission.id, submission.title, submission.author.name
-                    )
-                },
-            )
-    if new_created_utc:
+        newest = next(iter(reddit.subreddit(subreddit).new(limit=1)), None)
+        created_utc = newest.created_utc if newest else time.time()
+        LOGGER.info("Following %s from %i", subreddit, created_utc)
         conn.execute(
-            "INSERT OR REPLACE INTO post_slack (created_utc, subreddit) VALUES  (?, ?)",
-            (new_created_utc, subreddit),
+            "INSERT INTO post_slack (created_utc, scanned_utc, subreddit) VALUES (?, ?, ?)",
+            (created_utc, created_utc, subreddit),
         )
-        conn.commit()
-        LOGGER.debug("Updated created_utc %i", new_created_utc)
+    conn.commit()
+
+
+def enqueue(conn, subreddit, submission):
+    """Queue a submission if it is new, return True if queued"""
+    LOGGER.debug("Found %s", submission)
+    if not submission.author or submission.removed:
+        # deleted or removed
+        LOGGER.debug("Skipped: deleted or removed")
+        return False
+    if submission.created_utc <= get_created_utc(conn, subreddit):
+        return False
+    LOGGER.debug("OK: %i", submission.created_utc)
+    conn.execute(
+        """INSERT OR IGNORE INTO post_slack_queue (subreddit, id, title, author, created_utc)
+        VALUES (?, ?, ?, ?, ?)""",
+        (
+            subreddit,
+            submission.id,
+            submission.title,
+            submission.author.name,
+            submission.created_utc,
+        ),
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO post_slack (created_utc, subreddit) VALUES  (?, ?)",
+        (submission.created_utc, subreddit),
+    )
+    conn.commit()
+    LOGGER.debug("Updated created_utc %i", submission.created_utc)
+    return True
+
+
+def escape(text):
+    """Escape the control characters of Slack messages"""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def flush(conn, session, subreddit, hook_url):
+    """Send every queued submission in a single message"""
+    rows = conn.execute(
+        """SELECT id, title, author FROM post_slack_queue
+        WHERE subreddit = ? ORDER BY created_utc""",
+        [subreddit],
+    ).fetchall()
+    if not rows:
+        return
+    lines = [
+        "<https://redd.it/{}|{}> by {}".format(id_, escape(title), author)
+        for id_, title, author in rows
+    ]
+    if len(lines) == 1:
+        text = "New post: " + lines[0]
+    else:
+        text = "New posts:\n" + "\n".join(lines)
+    try:
+        r = session.post(hook_url, data={"payload": json.dumps({"text": text})}, timeout=30)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        # kept in queue, sent with the next message
+        LOGGER.warning("Slack error, %d posts queued: %s", len(rows), e)
+        return
+    conn.executemany(
+        "DELETE FROM post_slack_queue WHERE subreddit = ? AND id = ?",
+        [(subreddit, row[0]) for row in rows],
+    )
+    conn.commit()
+    LOGGER.debug("Sent %d posts", len(rows))
+
+
+def load_hooks(filename):
+    """Read a json object mapping each subreddit to its webhook"""
+    with open(filename, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def route(hooks, submission):
+    """Return the key of hooks for the subreddit of submission"""
+    name = submission.subreddit.display_name.lower()
+    for subreddit in hooks:
+        if subreddit.lower() == name:
+            return subreddit
+    return None
+
+
+def main(hooks):
+    """Send the new submissions of every subreddit to its webhook.
+
+    A single combined listing covers all the subreddits.
+    """
+    conn = open_db()
+    reddit = Reddit(check_for_updates=False)
+    seed(conn, reddit, hooks)
+    # moved by every run, even if nothing is queued
+    scanned_utc = min(get_scanned_utc(conn, subreddit) for subreddit in hooks)
+    LOGGER.debug("Scanned up to %i", scanned_utc)
+    rsubreddit = reddit.subreddit("+".join(hooks))
+    submissions = []
+    # paged until the oldest scan, a burst is not truncated
+    for submission in rsubreddit.new(limit=None):
+        if submission.created_utc <= scanned_utc:
+            # every subreddit already looked at it
+            break
+        submissions.append(submission)
+    for submission in reversed(submissions):
+        subreddit = route(hooks, submission)
+        if subreddit:
+            enqueue(conn, subreddit, submission)
+    if submissions:
+        set_scanned_utc(conn, hooks, submissions[0].created_utc)
+    session = slack_session()
+    for subreddit, hook_url in hooks.items():
+        flush(conn, session, subreddit, hook_url)
     conn.close()
 
 
-if __name__ == "__main__":
-    if len(argv) < 3:
-        print("Invoke the program with subreddit and HOOK_URL")
+def stream(hooks, window=BATCH_WINDOW):
+    """Follow the new submissions, sending messages every window seconds"""
+    conn = open_db()
+    session = slack_session()
+    reddit = Reddit(check_for_updates=False)
+    seed(conn, reddit, hooks)
+    rsubreddit = reddit.subreddit("+".join(hooks))
+    last_flush = time.time()
+    scanned_utc = 0
+    for submission in rsubreddit.stream.submissions(pause_after=0):
+        if submission is not None:
+            scanned_utc = max(scanned_utc, submission.created_utc)
+            subreddit = route(hooks, submission)
+            if subreddit:
+                enqueue(conn, subreddit, submission)
+        if time.time() - last_flush >= window:
+            if scanned_utc:
+                set_scanned_utc(conn, hooks, scanned_utc)
+            for subreddit, hook_url in hooks.items():
+                flush(conn, session, subreddit, hook_url)
+            last_flush = time.time()
+
+
+def cli():
+    """Provide the entry point to the command."""
+    parser = arg_parser(usage="usage: %(prog)s [options] (SUBREDDIT HOOK_URL | --config FILE)")
+    parser.add_argument("subreddit", type=str, nargs="?", help="The subreddit to follow")
+    parser.add_argument("hook_url", type=str, nargs="?", help="The Slack webhook")
+    parser.add_argument(
+        "--config",
+        type=str,
+        help="A json file mapping every subreddit to its webhook, instead of SUBREDDIT HOOK_URL",
+    )
+    parser.add_argument(
+        "--stream", action="store_true", help="Keep running, following new submissions"
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=BATCH_WINDOW,
+        help="Seconds of submissions grouped in a message, with --stream",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0, help="Verbose level"
+    )
+    options = parser.parse_args()
+
+    try:
+        LOGGER.setLevel([logging.NOTSET, logging.INFO, logging.DEBUG][options.verbose])
+    except IndexError:
+        LOGGER.setLevel(logging.DEBUG)
+    LOGGER.addHandler(logging.StreamHandler())
+
+    if options.config:
+        hooks = load_hooks(options.config)
+    elif options.subreddit and options.hook_url:
+        hooks = {options.subreddit: options.hook_url}
+    else:
+        parser.error("Invoke the program with subreddit and HOOK_URL, or --config")
+
+    if options.stream:
+        stream(hooks, options.window)
     else:
-        main(argv[1], argv[2])
+        main(hooks)
+
+
+if __name__ == "__main__":
+    cli()
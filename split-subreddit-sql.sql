@@ -8,4 +8,16 @@ CREATE TABLE old.comments AS SELECT * FROM comments WHERE created_utc < STRFTIME
 
 CREATE TABLE old.comments_awards AS SELECT * FROM comments_awards AS c WHERE EXISTS (SELECT id FROM old.comments WHERE comments.id = c.comment_id);
 
-CREATE TABLE old.traffics AS SELECT * FROM traffics WHERE day < STRFTIME('%s', DATE('now','start of month')) AND day > STRFTIME('%s', DATE('now','start of month', '-1 month'));
\ No newline at end of file
+CREATE TABLE old.traffics AS SELECT * FROM traffics WHERE day < STRFTIME('%s', DATE('now','start of month')) AND day > STRFTIME('%s', DATE('now','start of month', '-1 month'));
+
+CREATE TABLE old.authors AS SELECT * FROM authors WHERE id IN (SELECT author_id FROM old.submissions UNION SELECT author_id FROM old.comments);
+
+CREATE TABLE old.daily_activity AS SELECT * FROM daily_activity WHERE day < STRFTIME('%s', DATE('now','start of month')) AND day >= STRFTIME('%s', DATE('now','start of month', '-1 month'));
+
+CREATE TABLE old.author_daily AS SELECT * FROM author_daily WHERE day < STRFTIME('%s', DATE('now','start of month')) AND day >= STRFTIME('%s', DATE('now','start of month', '-1 month'));
+
+CREATE TABLE old.daily_awards AS SELECT * FROM daily_awards WHERE day < STRFTIME('%s', DATE('now','start of month')) AND day >= STRFTIME('%s', DATE('now','start of month', '-1 month'));
+
+CREATE TABLE old.zdict AS SELECT * FROM zdict;
+
+CREATE TABLE old.versions AS SELECT * FROM versions;
\ No newline at end of file
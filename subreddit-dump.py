@@ -2,9 +2,18 @@
 from argparse import ArgumentParser as arg_parser
 import csv
 import logging
+import sqlite3
 import time
 from praw import Reddit
 
+from subreddit_archive import (
+    LISTING_LIMIT,
+    TOP_DAYS,
+    namespace_factory,
+    register_body_text,
+    view_query,
+)
+
 AGENT = "python:subreddit-dump:0.1 (by /u/timendum)"
 TOP_VALUES = {"all", "day", "month", "week", "year"}
 
@@ -23,15 +32,41 @@ class CustomDialect(csv.Dialect):
     quoting = csv.QUOTE_MINIMAL
 
 
+DB_SUBMISSIONS = """SELECT s.id, s.title, s.score, s.upvote_ratio,
+    (SELECT name FROM authors WHERE authors.id = s.author_id) AS author, s.permalink,
+    s.created_utc, s.domain, s.domain LIKE 'self.%%' AS is_self,
+    body_text(s.selftext) AS selftext, s.link AS url,
+    s.flair_text AS link_flair_text, s.flair_class AS link_flair_css_class,
+    (SELECT COALESCE(SUM(a.count), 0) FROM submissions_awards AS a
+        WHERE a.submission_id = s.id) AS gilded,
+    s.num_comments, s.over_18
+FROM submissions AS s WHERE s.id IN (%s)"""
+
+
 class SubredditStats(object):
     """Contain all the functionality of the subreddit_stats command."""
 
-    def __init__(self, subreddit):
+    def __init__(self, subreddit, from_db=False):
         """Initialize the SubredditStats instance with config options."""
         self.submissions = []
-        self.max_date = time.time()  # - DAYS_IN_SECONDS * 7
-        self.reddit = Reddit(check_for_updates=False, user_agent=AGENT)
-        self.subreddit = self.reddit.subreddit(subreddit)
+        self.now = time.time()
+        self.min_date = 0
+        self.max_date = self.now  # - DAYS_IN_SECONDS * 7
+        # submissions fetched by any view, by id
+        self.store = {}
+        # oldest date from which every submission up to now is in the store
+        self.complete_since = None
+        if from_db:
+            # read the archive of subreddit-sql.py, no API calls
+            self.reddit = None
+            self.subreddit = subreddit
+            self.con = sqlite3.connect("file:%s.db?mode=ro" % subreddit, uri=True)
+            self.con.row_factory = namespace_factory
+            register_body_text(self.con)
+        else:
+            self.con = None
+            self.reddit = Reddit(check_for_updates=False, user_agent=AGENT)
+            self.subreddit = self.reddit.subreddit(subreddit)
 
     def fetch_recent_submissions(self, max_duration):
         """Fetch recent submissions in subreddit with boundaries.
@@ -47,10 +82,12 @@ class SubredditStats(object):
         LOGGER.debug("Fetching submissions between %i and %i", self.min_date, self.max_date)
         for submission in self.subreddit.new(limit=None):
             if submission.created_utc <= self.min_date:
-                continue
+                # sorted by date: every newer submission was already seen
+                self.set_complete(self.min_date)
+                break
             if submission.created_utc > self.max_date:
                 continue
-            self.submissions.append(submission)
+            self.submissions.append(self.store.setdefault(submission.id, submission))
 
     def fetch_top_submissions(self, top):
         """Fetch top submissions by some top value.
@@ -60,8 +97,50 @@ class SubredditStats(object):
 
         """
         LOGGER.debug("Fetching top submissions with limit=%s", top)
+        # a listing may be truncated at any length: the window is never complete
         for submission in self.subreddit.top(limit=None, time_filter=top):
-            self.submissions.append(submission)
+            self.submissions.append(self.store.setdefault(submission.id, submission))
+
+    def set_complete(self, min_date):
+        """Record that the store holds every submission newer than min_date."""
+        if self.complete_since is None or min_date < self.complete_since:
+            self.complete_since = min_date
+
+    def view_min_date(self, view):
+        """Return the oldest date included in a view."""
+        if view in TOP_VALUES:
+            if TOP_DAYS[view] is None:
+                return 0
+            return self.now - DAYS_IN_SECONDS * TOP_DAYS[view]
+        return self.now - DAYS_IN_SECONDS * int(view)
+
+    def is_covered(self, view):
+        """Return True if the view can be produced from the store alone."""
+        return self.complete_since is not None and self.complete_since <= self.view_min_date(view)
+
+    def fetch_stored_submissions(self, view):
+        """Fetch the submissions of a view from the ones already fetched.
+
+        :param view: The number of latest days or one of TOP_VALUES
+
+        """
+        LOGGER.debug("Filtering stored submissions with view=%s", view)
+        min_date = self.view_min_date(view)
+        submissions = [s for s in self.store.values() if s.created_utc > min_date]
+        if view in TOP_VALUES:
+            submissions.sort(key=lambda x: x.score, reverse=True)
+            submissions = submissions[:LISTING_LIMIT]
+        self.submissions.extend(submissions)
+
+    def fetch_db_submissions(self, view):
+        """Fetch the submissions of a view from the archive.
+
+        :param view: The number of latest days or one of TOP_VALUES
+
+        """
+        LOGGER.debug("Fetching archived submissions with view=%s", view)
+        query, params = view_query(view, self.max_date)
+        self.submissions.extend(self.con.execute(DB_SUBMISSIONS % query, params))
 
     def fetch_submissions(self, submissions_callback, *args):
         """Wrap the submissions_callback function."""
@@ -126,11 +205,35 @@ class SubredditStats(object):
         submissions_file = self.process_submissions()
         return submissions_file
 
-    def run(self, view):
-        """Run stats and return the created Submission."""
-        LOGGER.info("Analyzing subreddit: %s", self.subreddit.display_name)
+    def run(self, views):
+        """Export every view and return the created files.
 
-        if view in TOP_VALUES:
+        Views are processed from the widest to the narrowest, so that the
+        narrow ones can be produced from submissions already fetched.
+
+        """
+        LOGGER.info("Analyzing subreddit: %s", self.subreddit)
+        files = []
+        for view in sorted(views, key=self.view_min_date):
+            self.submissions = []
+            self.min_date = 0
+            self.max_date = self.now
+            file = self.run_view(view)
+            if file:
+                files.append(file)
+        return files
+
+    def run_view(self, view):
+        """Export a view and return the created file."""
+        if self.con:
+            callback = self.fetch_db_submissions
+            if view not in TOP_VALUES:
+                view = int(view)
+        elif self.is_covered(view):
+            callback = self.fetch_stored_submissions
+            if view not in TOP_VALUES:
+                view = int(view)
+        elif view in TOP_VALUES:
             callback = self.fetch_top_submissions
         else:
             callback = self.fetch_recent_submissions
@@ -138,7 +241,7 @@ class SubredditStats(object):
         self.fetch_submissions(callback, view)
 
         if not self.submissions:
-            LOGGER.warning("No submissions were found.")
+            LOGGER.warning("No submissions were found for %s.", view)
             return
 
         return self.publish_results(view)
@@ -146,17 +249,23 @@ class SubredditStats(object):
 
 def main():
     """Provide the entry point to the subreddit_stats command."""
-    parser = arg_parser(usage="usage: %(prog)s [options] SUBREDDIT VIEW")
+    parser = arg_parser(usage="usage: %(prog)s [options] SUBREDDIT VIEW [VIEW ...]")
     parser.add_argument("subreddit", type=str, help="The subreddit to be analyzed")
     parser.add_argument(
         "view",
         type=str,
+        nargs="+",
         help="The number of latest days or one of the reddit view (%s)"
         % ",".join(TOP_VALUES),
     )
     parser.add_argument(
         "--verbose", type=int, default=0, help="0 for disabled, 1 for info, more for debug"
     )
+    parser.add_argument(
+        "--from-db",
+        action="store_true",
+        help="Read from the SUBREDDIT.db archive of subreddit-sql.py",
+    )
 
     options = parser.parse_args()
 
@@ -168,9 +277,8 @@ def main():
         LOGGER.setLevel(logging.NOTSET)
     LOGGER.addHandler(logging.StreamHandler())
 
-    srs = SubredditStats(options.subreddit)
-    file = srs.run(options.view)
-    if file:
+    srs = SubredditStats(options.subreddit, options.from_db)
+    for file in srs.run(options.view):
         print("File written : " + file)
     return 0
 
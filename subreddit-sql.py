@@ -1,29 +1,225 @@
 """Utility to save submissions, comments and awards from a subreddit into a sqlite database and keep it updated."""
 from argparse import ArgumentParser as arg_parser
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, UTC
+from types import SimpleNamespace
+import io
+import json
+import re
 import sqlite3
 import logging
+import queue
+import threading
+import time
+import zlib
+import prawcore
 from praw import Reddit
+from praw.models import MoreComments
+
+from subreddit_archive import ZDICT_HEADER
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 LOGGER = logging.getLogger(__file__)
 
 SECONDS_IN_DAY = 60 * 60 * 24
+# Start of the UTC day of a timestamp, in sql
+DAY_SQL = f"(CAST({{}} AS INTEGER) / {SECONDS_IN_DAY} * {SECONDS_IN_DAY})"
+
+DELETED = "[deleted]"
+
+# Intervals between two refreshes of a submission: longer while it does not
+# change, shorter again when it does
+REFRESH_STEPS = (
+    60 * 60,
+    6 * 60 * 60,
+    SECONDS_IN_DAY,
+    7 * SECONDS_IN_DAY,
+    30 * SECONDS_IN_DAY,
+)
+# Reddit archives submissions after 6 months: no more votes or comments
+FREEZE_AGE = 180 * SECONDS_IN_DAY
+# Max number of submissions refreshed by a run
+REFRESH_BUDGET = 1000
+# Refresh step after a scheduled refresh, in the submissions upsert: one step
+# longer if score and comments did not change, one step shorter if they did
+SCHEDULE_STEP_SQL = (
+    "(CASE WHEN excluded.score IS submissions.score"
+    " AND excluded.num_comments IS submissions.num_comments"
+    f" THEN MIN(submissions.refresh_step + 1, {len(REFRESH_STEPS) - 1})"
+    " ELSE MAX(submissions.refresh_step - 1, 0) END)"
+)
+# Interval of a refresh step, in sql
+INTERVAL_SQL = "(CASE {} %s END)" % " ".join(
+    f"WHEN {step} THEN {interval}" for step, interval in enumerate(REFRESH_STEPS)
+)
+# First refresh step of a submission of some age, in sql
+AGE_STEP_SQL = "(%s)" % " + ".join(f"({{0}} >= {interval})" for interval in REFRESH_STEPS[1:])
+# Current time, in sql
+NOW_SQL = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+# Resumes retrying a submission before a run gives it up
+RUN_ATTEMPTS = 3
+
+# Max number of fullnames in a /api/info request
+INFO_CHUNK = 100
+# Rows of a dump written with a single executemany
+IMPORT_BATCH = 10_000
+# Author ids kept in memory, the cache is emptied when it grows past it
+AUTHOR_CACHE = 100_000
+# Batches waiting for the writer thread before the fetchers are stopped
+WRITE_QUEUE = 32
+# Rows written by the writer thread in a single transaction
+WRITE_COMMIT = 500_000
+# Max seconds between two commits of the writer thread
+COMMIT_SECONDS = 10
+# Max size of a compression dictionary, the deflate window
+ZDICT_SIZE = 32 * 1024
+# Latest comments used to build a compression dictionary
+ZDICT_SAMPLE = 20_000
+# Rows compressed in a single transaction by --compress
+COMPRESS_BATCH = 10_000
+# Attributes of the dump objects read by the row builders
+DUMP_FIELDS = (
+    "id",
+    "title",
+    "score",
+    "upvote_ratio",
+    "permalink",
+    "domain",
+    "selftext",
+    "url",
+    "link_flair_text",
+    "link_flair_css_class",
+    "num_comments",
+    "over_18",
+    "distinguished",
+    "removed",
+    "removed_by_category",
+    "locked",
+    "link_id",
+    "parent_id",
+    "body",
+    "collapsed",
+)
+
+
+def read_dump(filename: str):
+    """Yield the lines of a Pushshift dump, .zst compressed or plain ndjson."""
+    if not filename.endswith(".zst"):
+        with open(filename, encoding="utf-8", errors="replace") as f:
+            yield from f
+        return
+    with open(filename, "rb") as fh:
+        # the monthly dumps are compressed with a long window
+        reader = zstandard.ZstdDecompressor(max_window_size=2**31).stream_reader(fh)
+        yield from io.TextIOWrapper(reader, encoding="utf-8", errors="replace")
+
+
+def first_step(age: float) -> int:
+    """Return the first refresh step of a submission of some age.
+
+    The interval of the step is the longest one not longer than the age.
+    """
+    return sum(age >= interval for interval in REFRESH_STEPS[1:])
+
+
+def next_refresh(created_utc: float, last_update: int, step: int, now: float) -> int | None:
+    """Return the date of the next refresh, None if the submission is archived by now."""
+    if created_utc + FREEZE_AGE <= now:
+        return None
+    return last_update + REFRESH_STEPS[step]
+
+
+def train_zdict(texts) -> bytes:
+    """Build a deflate dictionary from the words and word pairs common in texts.
+
+    The most common ones are at the end, where they are the cheapest to reference.
+    """
+    counts = Counter()
+    for text in texts:
+        words = text.split()
+        counts.update(words)
+        counts.update(" ".join(pair) for pair in zip(words, words[1:]))
+    parts = []
+    size = 0
+    for part, count in counts.most_common():
+        if count < 2 or size + len(part.encode("utf-8")) + 1 > ZDICT_SIZE:
+            break
+        parts.append(part)
+        size += len(part.encode("utf-8")) + 1
+    return " ".join(reversed(parts)).encode("utf-8")
+
+
+def dump_item(obj: dict) -> SimpleNamespace:
+    """Return a dump object with the attributes of the praw ones."""
+    item = SimpleNamespace(**{field: obj.get(field) for field in DUMP_FIELDS})
+    author = obj.get("author")
+    item.author = SimpleNamespace(name=author) if author and author != DELETED else None
+    item.created_utc = int(obj["created_utc"])
+    item.all_awardings = obj.get("all_awardings") or []
+    return item
 
 
 class SubredditDump(object):
-    def __init__(self, subreddit):
+    def __init__(self, subreddit, offline=False):
         """Initialize the SubredditStats instance with config options."""
-        self.reddit = Reddit(check_for_updates=False)
-        if not self.reddit.user.me():
-            print(self.reddit.auth.url(scopes=["read", "identity"], state=""))
-        self.subreddit = self.reddit.subreddit(subreddit)
-        self.con = sqlite3.connect(f"{subreddit}.db")
+        self.subreddit_name = subreddit
+        if offline:
+            # importing dumps, no API calls
+            self.reddit = None
+            self.subreddit = None
+        else:
+            self.reddit = Reddit(check_for_updates=False)
+            if not self.reddit.user.me():
+                print(self.reddit.auth.url(scopes=["read", "identity"], state=""))
+            self.subreddit = self.reddit.subreddit(subreddit)
+        # used by the writer thread, while it runs
+        self.con = sqlite3.connect(f"{subreddit}.db", check_same_thread=False)
         self._init_sql()
+        # (id, data) of the dictionary compressing the new bodies, None to store text
+        self._zdict = self.con.execute(
+            "SELECT id, data FROM zdict ORDER BY id DESC LIMIT 1"
+        ).fetchone()
         self.submissions = []
-        self.comments = []
         self._now = int(datetime.now(UTC).timestamp())
+        # author name -> authors.id
+        self._authors = {}
+        # batches for the writer thread, None when it is not running
+        self._queue = None
+        self._writer_error = None
+        # for the fetchers, while the writer owns self.con
+        self._reader = sqlite3.connect(
+            f"file:{subreddit}.db?mode=ro", uri=True, check_same_thread=False
+        )
+        self._reader_lock = threading.Lock()
+        # the Reddit instance of each fetcher thread
+        self._local = threading.local()
+        # num_comments in the archive of the submissions to refresh
+        self._stored_num_comments = {}
+        # runs.id of the run in progress, None outside run
+        self._run_id = None
 
     def _init_sql(self) -> None:
+        # readers, like archive_server.py, do not block the writer
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            """
+CREATE TABLE IF NOT EXISTS authors(
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    created_utc INTEGER,
+    comment_karma INTEGER,
+    link_karma INTEGER,
+    is_suspended BOOLEAN,
+    last_active INTEGER,
+    enriched_at INTEGER)"""
+        )
         self.con.execute(
             """
 CREATE TABLE IF NOT EXISTS submissions(
@@ -31,7 +227,7 @@ CREATE TABLE IF NOT EXISTS submissions(
     title TEXT,
     score INTEGER,
     upvote_ratio REAL,
-    author TEXT,
+    author_id INTEGER REFERENCES authors(id),
     permalink TEXT,
     created_utc INTEGER,
     domain TEXT,
@@ -45,7 +241,9 @@ CREATE TABLE IF NOT EXISTS submissions(
     removed BOOLEAN,
     removed_by_category TEXT,
     locked BOOLEAN,
-    last_update NOT NULL)"""
+    last_update NOT NULL,
+    refresh_step INTEGER NOT NULL DEFAULT 0,
+    next_refresh_at INTEGER)"""
         )
         self.con.execute(
             """
@@ -63,7 +261,7 @@ CREATE TABLE IF NOT EXISTS submissions_awards(
 CREATE TABLE IF NOT EXISTS comments(
     id TEXT PRIMARY KEY,
     score INTEGER,
-    author TEXT,
+    author_id INTEGER REFERENCES authors(id),
     submission_id TEXT,
     created_utc INTEGER,
     parent_id TEXT,
@@ -93,9 +291,300 @@ CREATE TABLE IF NOT EXISTS traffics(
     pageviews INTEGER,
     uniques INTEGER,
     new_members INTEGER)"""
+        )
+        # Dictionaries of the compressed bodies, see compress
+        self.con.execute(
+            """
+CREATE TABLE IF NOT EXISTS zdict(
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    created_utc INTEGER)"""
+        )
+        # Write counter of each table, the readers cache results while it is unchanged
+        self.con.execute(
+            """
+CREATE TABLE IF NOT EXISTS versions(
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL)"""
+        )
+        self._migrate_authors()
+        self._migrate_schedule()
+        # Indexes used by the readers of the archive
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS submissions_author_id ON submissions(author_id)"
+        )
+        self.con.execute("CREATE INDEX IF NOT EXISTS comments_author_id ON comments(author_id)")
+        self.con.execute("CREATE INDEX IF NOT EXISTS authors_last_active ON authors(last_active)")
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS submissions_created_utc ON submissions(created_utc)"
+        )
+        self.con.execute("CREATE INDEX IF NOT EXISTS submissions_score ON submissions(score)")
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS comments_submission_id ON comments(submission_id)"
+        )
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS comments_created_utc ON comments(created_utc)"
+        )
+        self.con.execute(
+            """CREATE INDEX IF NOT EXISTS submissions_awards_submission_id
+    ON submissions_awards(submission_id)"""
+        )
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS comments_awards_comment_id ON comments_awards(comment_id)"
+        )
+        # the cache of subreddit_archive reads the versions table now
+        self.con.execute("DROP INDEX IF EXISTS submissions_last_update")
+        self.con.execute("DROP INDEX IF EXISTS comments_last_update")
+        self.con.execute(
+            """CREATE INDEX IF NOT EXISTS submissions_next_refresh_at
+    ON submissions(next_refresh_at) WHERE next_refresh_at IS NOT NULL"""
+        )
+        self._init_rollups()
+        # Journal of the runs: the items left by a run interrupted are taken over
+        # by the next one with its args
+        self.con.execute(
+            """
+CREATE TABLE IF NOT EXISTS runs(
+    id INTEGER PRIMARY KEY,
+    args TEXT NOT NULL,
+    started_at INTEGER NOT NULL,
+    finished_at INTEGER)"""
+        )
+        # state is listed, expanded (comments fetched), written or failed
+        self.con.execute(
+            """
+CREATE TABLE IF NOT EXISTS run_items(
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    submission_id TEXT NOT NULL,
+    pass TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at INTEGER NOT NULL,
+    PRIMARY KEY (run_id, submission_id))"""
         )
         self.con.commit()
 
+    def _init_rollups(self) -> None:
+        """Create the daily rollup tables, kept current by triggers.
+
+        daily_activity counts submissions and comments by day, author_daily
+        the same by author and day, daily_awards the awards and coins by day
+        of the awarded item and award name (day 0 if the item is not stored).
+        Tables are filled from the existing rows when created.
+        """
+        exists = self.con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_activity'"
+        ).fetchone()
+        self.con.execute(
+            """
+CREATE TABLE IF NOT EXISTS daily_activity(
+    day INTEGER PRIMARY KEY,
+    submissions INTEGER NOT NULL DEFAULT 0,
+    comments INTEGER NOT NULL DEFAULT 0)"""
+        )
+        self.con.execute(
+            """
+CREATE TABLE IF NOT EXISTS author_daily(
+    author_id INTEGER REFERENCES authors(id),
+    day INTEGER,
+    submissions INTEGER NOT NULL DEFAULT 0,
+    comments INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (author_id, day))"""
+        )
+        self.con.execute(
+            """
+CREATE TABLE IF NOT EXISTS daily_awards(
+    day INTEGER,
+    name TEXT,
+    count INTEGER NOT NULL DEFAULT 0,
+    coins INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, name))"""
+        )
+        self.con.execute("CREATE INDEX IF NOT EXISTS author_daily_day ON author_daily(day)")
+        for table in ("submissions", "comments"):
+            day = DAY_SQL.format("{0}.created_utc")
+            for event, row, sign in (("INSERT", "NEW", "+"), ("DELETE", "OLD", "-")):
+                self.con.execute(
+                    f"""
+CREATE TRIGGER IF NOT EXISTS {table}_rollup_{event.lower()} AFTER {event} ON {table}
+BEGIN
+    INSERT INTO daily_activity(day, {table}) VALUES({day.format(row)}, {sign}1)
+        ON CONFLICT(day) DO UPDATE SET {table} = {table} {sign} 1;
+    INSERT INTO author_daily(author_id, day, {table})
+        VALUES({row}.author_id, {day.format(row)}, {sign}1)
+        ON CONFLICT(author_id, day) DO UPDATE SET {table} = {table} {sign} 1;
+END"""
+                )
+        for table, parent, parent_id in (
+            ("submissions_awards", "submissions", "submission_id"),
+            ("comments_awards", "comments", "comment_id"),
+        ):
+            day = "COALESCE((SELECT {} FROM {} WHERE id = {{0}}.{}), 0)".format(
+                DAY_SQL.format("created_utc"), parent, parent_id
+            )
+            add = """
+    INSERT INTO daily_awards(day, name, count, coins)
+        VALUES({day}, {row}.name, {sign}{row}.count, {sign}{row}.count * {row}.coin_price)
+        ON CONFLICT(day, name) DO UPDATE SET
+        count = count + excluded.count, coins = coins + excluded.coins;"""
+            for event, changes in (
+                ("INSERT", (("NEW", "+"),)),
+                ("DELETE", (("OLD", "-"),)),
+                ("UPDATE", (("OLD", "-"), ("NEW", "+"))),
+            ):
+                body = "".join(
+                    add.format(day=day.format(row), row=row, sign=sign) for row, sign in changes
+                )
+                self.con.execute(
+                    f"""
+CREATE TRIGGER IF NOT EXISTS {table}_rollup_{event.lower()} AFTER {event} ON {table}
+BEGIN{body}
+END"""
+                )
+        if exists:
+            return
+        LOGGER.info("Filling the rollup tables")
+        for table in ("submissions", "comments"):
+            day = DAY_SQL.format("created_utc")
+            self.con.execute(
+                f"""INSERT INTO daily_activity(day, {table})
+    SELECT {day}, COUNT(*) FROM {table} WHERE true GROUP BY 1
+    ON CONFLICT(day) DO UPDATE SET {table} = excluded.{table}"""
+            )
+            self.con.execute(
+                f"""INSERT INTO author_daily(author_id, day, {table})
+    SELECT author_id, {day}, COUNT(*) FROM {table} WHERE true GROUP BY 1, 2
+    ON CONFLICT(author_id, day) DO UPDATE SET {table} = excluded.{table}"""
+            )
+        for table, parent, parent_id in (
+            ("submissions_awards", "submissions", "submission_id"),
+            ("comments_awards", "comments", "comment_id"),
+        ):
+            day = DAY_SQL.format("p.created_utc")
+            self.con.execute(
+                f"""INSERT INTO daily_awards(day, name, count, coins)
+    SELECT COALESCE({day}, 0), a.name, SUM(a.count), SUM(a.count * a.coin_price)
+    FROM {table} AS a LEFT JOIN {parent} AS p ON p.id = a.{parent_id} WHERE true GROUP BY 1, 2
+    ON CONFLICT(day, name) DO UPDATE SET
+    count = count + excluded.count, coins = coins + excluded.coins"""
+            )
+
+    def _migrate_authors(self) -> None:
+        """Move author names of an old archive to the authors table."""
+        for table in ("submissions", "comments"):
+            columns = {row[1] for row in self.con.execute(f"PRAGMA table_info({table})")}
+            if "author" not in columns:
+                continue
+            LOGGER.info("Moving %s authors to the authors table", table)
+            self.con.execute(
+                f"""INSERT OR IGNORE INTO authors(name)
+    SELECT DISTINCT author FROM {table} WHERE author IS NOT NULL"""
+            )
+            self.con.execute(
+                f"ALTER TABLE {table} ADD COLUMN author_id INTEGER REFERENCES authors(id)"
+            )
+            self.con.execute(
+                f"""UPDATE {table} SET author_id =
+    (SELECT id FROM authors WHERE authors.name = {table}.author)"""
+            )
+            self.con.execute(
+                f"CREATE INDEX IF NOT EXISTS {table}_author_id ON {table}(author_id)"
+            )
+            self.con.execute(f"ALTER TABLE {table} DROP COLUMN author")
+            self.con.execute(
+                f"""UPDATE authors SET last_active = MAX(COALESCE(last_active, 0),
+    (SELECT MAX(created_utc) FROM {table} WHERE author_id = authors.id))
+    WHERE id IN (SELECT author_id FROM {table})"""
+            )
+        self.con.commit()
+
+    def _migrate_schedule(self) -> None:
+        """Schedule the next refresh of the submissions of an old archive, by age."""
+        columns = {row[1] for row in self.con.execute("PRAGMA table_info(submissions)")}
+        if "next_refresh_at" in columns:
+            return
+        LOGGER.info("Scheduling the refresh of the submissions")
+        self.con.execute(
+            "ALTER TABLE submissions ADD COLUMN refresh_step INTEGER NOT NULL DEFAULT 0"
+        )
+        self.con.execute("ALTER TABLE submissions ADD COLUMN next_refresh_at INTEGER")
+        step = AGE_STEP_SQL.format("last_update - created_utc")
+        self.con.execute(f"UPDATE submissions SET refresh_step = {step}")
+        self.con.execute(
+            f"""UPDATE submissions SET next_refresh_at =
+    last_update + {INTERVAL_SQL.format("refresh_step")}
+    WHERE created_utc + {FREEZE_AGE} > {NOW_SQL}"""
+        )
+        self.con.commit()
+
+    def _author_id(self, name: str) -> int:
+        """Return the id of the author, adding it if needed."""
+        author_id = self._authors.get(name)
+        if author_id is None:
+            self.con.execute("INSERT OR IGNORE INTO authors(name) VALUES(?)", (name,))
+            author_id = self.con.execute(
+                "SELECT id FROM authors WHERE name = ?", (name,)
+            ).fetchone()[0]
+            if len(self._authors) >= AUTHOR_CACHE:
+                self._authors.clear()
+            self._authors[name] = author_id
+        return author_id
+
+    def _bump(self, *tables: str) -> None:
+        """Count a write of tables, committed with it."""
+        self.con.executemany(
+            """INSERT INTO versions(name, version) VALUES(?, 1)
+    ON CONFLICT(name) DO UPDATE SET version = version + 1""",
+            [(table,) for table in tables],
+        )
+
+    def _update_last_active(self, last_active: dict[int, int]) -> None:
+        """Update the latest activity of the authors."""
+        self.con.executemany(
+            "UPDATE authors SET last_active = MAX(COALESCE(last_active, 0), ?) WHERE id = ?",
+            [(created_utc, author_id) for author_id, created_utc in last_active.items()],
+        )
+
+    def enrich_authors(self, limit: int, ttl_days: int) -> None:
+        """Fetch the details of authors never enriched or enriched too long ago.
+
+        Most recently active authors come first.
+
+        :param limit: The maximum number of authors to fetch
+        :param ttl_days: The number of days details are valid
+
+        """
+        rows = self.con.execute(
+            """SELECT id, name FROM authors WHERE name != ?
+    AND (enriched_at IS NULL OR enriched_at < ?)
+    ORDER BY last_active DESC LIMIT ?""",
+            (DELETED, self._now - ttl_days * SECONDS_IN_DAY, limit),
+        ).fetchall()
+        LOGGER.debug("Enriching %d authors", len(rows))
+        for author_id, name in rows:
+            redditor = self.reddit.redditor(name)
+            try:
+                if getattr(redditor, "is_suspended", False):
+                    values = (None, None, None, True)
+                else:
+                    values = (
+                        redditor.created_utc,
+                        redditor.comment_karma,
+                        redditor.link_karma,
+                        False,
+                    )
+            except prawcore.exceptions.NotFound:
+                LOGGER.debug("Author %s not found", name)
+                values = (None, None, None, None)
+            self.con.execute(
+                """UPDATE authors SET created_utc = ?, comment_karma = ?, link_karma = ?,
+    is_suspended = ?, enriched_at = ? WHERE id = ?""",
+                values + (self._now, author_id),
+            )
+        self._bump("authors")
+        self.con.commit()
+
     def fetch_recent_submissions(self, days_old: int) -> None:
         """Fetch recent submissions in subreddit with boundaries.
 
@@ -133,217 +622,730 @@ CREATE TABLE IF NOT EXISTS traffics(
         )
         self.con.commit()
 
-    def process_submissions(self) -> None:
-        """Write submissions file."""
-        LOGGER.debug("Processing %d submissions", len(self.submissions))
-        dsubmissions = []
-        dawards = []
-        for s in self.submissions:
-            dsubmissions.append(
-                (
-                    s.id,
-                    s.title,
-                    s.score,
-                    s.upvote_ratio,
-                    s.author.name if s.author else "[deleted]",
-                    s.permalink,
-                    s.created_utc,
-                    s.domain,
-                    getattr(s, "selftext", None),
-                    getattr(s, "url", None),
-                    s.link_flair_text,
-                    s.link_flair_css_class,
-                    s.num_comments,
-                    s.over_18,
-                    s.distinguished,
-                    s.removed,
-                    s.removed_by_category,
-                    s.locked,
-                    self._now,
+    def _pack(self, text: str | None) -> str | bytes | None:
+        """Return text compressed, if compression is on and it is shorter."""
+        if not text or self._zdict is None:
+            return text
+        zdict_id, zdict = self._zdict
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+        data = text.encode("utf-8")
+        packed = ZDICT_HEADER.pack(zdict_id) + compressor.compress(data) + compressor.flush()
+        return packed if len(packed) < len(data) else text
+
+    def compress(self) -> None:
+        """Turn on the compression of bodies and selftexts and compress the stored ones.
+
+        The dictionary is built from the latest comments of the archive. Once
+        it exists, new bodies are stored compressed; readers get them back
+        with the body_text() sql function of subreddit_archive.
+        """
+        if self._zdict is None:
+            texts = [
+                row[0]
+                for row in self.con.execute(
+                    """SELECT body FROM comments WHERE typeof(body) = 'text'
+    ORDER BY created_utc DESC LIMIT ?""",
+                    (ZDICT_SAMPLE,),
                 )
+            ]
+            zdict = train_zdict(texts)
+            cur = self.con.execute(
+                "INSERT INTO zdict(data, created_utc) VALUES(?, ?)", (zdict, self._now)
             )
-            for award in s.all_awardings:
-                dawards.append(
-                    (
-                        award["id"],
-                        s.id,
-                        award["name"],
-                        award["count"],
-                        award["award_type"],
-                        award["coin_price"],
-                        self._now,
-                    )
+            self._zdict = (cur.lastrowid, zdict)
+            self.con.commit()
+            LOGGER.info("Built a dictionary of %d bytes from %d comments", len(zdict), len(texts))
+        for table, column in (("comments", "body"), ("submissions", "selftext")):
+            count = 0
+            last = 0
+            while True:
+                rows = self.con.execute(
+                    f"""SELECT rowid, {column} FROM {table}
+    WHERE rowid > ? AND typeof({column}) = 'text' ORDER BY rowid LIMIT ?""",
+                    (last, COMPRESS_BATCH),
+                ).fetchall()
+                if not rows:
+                    break
+                last = rows[-1][0]
+                self.con.executemany(
+                    f"UPDATE {table} SET {column} = ? WHERE rowid = ?",
+                    [(self._pack(text), rowid) for rowid, text in rows],
                 )
+                self.con.commit()
+                count += len(rows)
+            LOGGER.info("Compressed %d %s", count, table)
+        # give the space back to the file system
+        self.con.execute("VACUUM")
+
+    def _submission_rows(self, s, last_update: int) -> tuple[tuple, list[tuple]]:
+        """Return the row of a submission, with the author name, and the rows of its awards."""
+        row = (
+            s.id,
+            s.title,
+            s.score,
+            s.upvote_ratio,
+            s.author.name if s.author else DELETED,
+            s.permalink,
+            s.created_utc,
+            s.domain,
+            self._pack(getattr(s, "selftext", None)),
+            getattr(s, "url", None),
+            s.link_flair_text,
+            s.link_flair_css_class,
+            s.num_comments,
+            s.over_18,
+            s.distinguished,
+            s.removed,
+            s.removed_by_category,
+            s.locked,
+            last_update,
+            first_step(last_update - s.created_utc),
+        )
+        row += (next_refresh(s.created_utc, last_update, row[-1], self._now),)
+        awards = [
+            (
+                award["id"],
+                s.id,
+                award["name"],
+                award["count"],
+                award["award_type"],
+                award["coin_price"],
+                last_update,
+            )
+            for award in s.all_awardings
+        ]
+        return row, awards
+
+    def _save_submissions(self, dsubmissions: list[tuple], dawards: list[tuple]) -> None:
+        """Insert or update submissions and awards, unless stored ones are newer."""
+        last_active = {}
+        for index, row in enumerate(dsubmissions):
+            author_id = self._author_id(row[4])
+            last_active[author_id] = max(last_active.get(author_id, 0), row[6])
+            dsubmissions[index] = row[:4] + (author_id,) + row[5:]
         self.con.executemany(
             """INSERT INTO submissions
-    (id, title, score, upvote_ratio, author, permalink, created_utc, domain, selftext, link,
+    (id, title, score, upvote_ratio, author_id, permalink, created_utc, domain, selftext, link,
     flair_text, flair_class, num_comments, over_18, distinguished, removed, removed_by_category,
-    locked, last_update)
-    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    locked, last_update, refresh_step, next_refresh_at)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     ON CONFLICT(id) DO UPDATE SET
     score=excluded.score, upvote_ratio=excluded.upvote_ratio, selftext=excluded.selftext,
     flair_text=excluded.flair_text, flair_class=excluded.flair_class,
     num_comments=excluded.num_comments, over_18=excluded.over_18,
     distinguished=excluded.distinguished, removed=excluded.removed,
     removed_by_category=excluded.removed_by_category,
-    locked=excluded.locked, last_update=excluded.last_update""",
+    locked=excluded.locked, last_update=excluded.last_update,
+    refresh_step=CASE WHEN submissions.next_refresh_at <= excluded.last_update
+        THEN {step} ELSE submissions.refresh_step END,
+    next_refresh_at=CASE WHEN submissions.next_refresh_at <= excluded.last_update
+        THEN CASE WHEN submissions.created_utc + {freeze} > {now}
+            THEN excluded.last_update + {interval} END
+        ELSE submissions.next_refresh_at END
+    WHERE excluded.last_update >= submissions.last_update""".format(
+                step=SCHEDULE_STEP_SQL,
+                freeze=FREEZE_AGE,
+                now=NOW_SQL,
+                interval=INTERVAL_SQL.format(SCHEDULE_STEP_SQL),
+            ),
             dsubmissions,
         )
         if dawards:
             LOGGER.debug("Processing %d submission awards", len(dawards))
             self.con.executemany(
-                """INSERT OR REPLACE INTO submissions_awards
+                """INSERT INTO submissions_awards
     (id, submission_id, name, count, award_type, coin_price, last_update)
-    VALUES(?, ?, ?, ?, ?, ?, ?)""",
+    VALUES(?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+    submission_id=excluded.submission_id, name=excluded.name, count=excluded.count,
+    award_type=excluded.award_type, coin_price=excluded.coin_price,
+    last_update=excluded.last_update
+    WHERE excluded.last_update >= submissions_awards.last_update""",
                 dawards,
             )
+        self._update_last_active(last_active)
+        self._bump("submissions", "authors")
 
-        self.con.commit()
+    @contextmanager
+    def writer(self):
+        """Run the writer thread, the only user of the connection, in the block.
+
+        Rows given to _write are queued and written in the order they come,
+        with a commit every WRITE_COMMIT rows or COMMIT_SECONDS. When the
+        queue is full, _write waits. After a failed write the rows not
+        committed are rolled back and _write raises.
+        """
+        self._queue = queue.Queue(maxsize=WRITE_QUEUE)
+        self._writer_error = None
+        thread = threading.Thread(target=self._write_loop, name="writer")
+        thread.start()
+        try:
+            yield
+        finally:
+            self._queue.put(None)
+            thread.join()
+            self._queue = None
+            error, self._writer_error = self._writer_error, None
+        if error:
+            raise error
 
-    def fetch_comments_from_submissions(self) -> None:
-        for index, submission in enumerate(self.submissions):
-            if submission.num_comments == 0:
+    def _write_loop(self) -> None:
+        pending = 0
+        last_commit = time.monotonic()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._writer_error:
+                # discarded until the end of the block
                 continue
+            table, rows, awards = item
+            try:
+                if table == "run_items":
+                    self._save_journal(rows)
+                elif table == "submissions":
+                    self._save_submissions(rows, awards)
+                else:
+                    self._save_comments(rows, awards)
+                pending += len(rows)
+                # a journal entry commits the rows before it
+                if (
+                    table == "run_items"
+                    or pending >= WRITE_COMMIT
+                    or time.monotonic() - last_commit >= COMMIT_SECONDS
+                ):
+                    self.con.commit()
+                    pending = 0
+                    last_commit = time.monotonic()
+            except Exception as e:
+                LOGGER.error("Writer stopped: %s", e)
+                self._writer_error = e
+                self.con.rollback()
+        if not self._writer_error:
+            self.con.commit()
 
-            more_comments = submission.comments.replace_more(limit=None)
-            if more_comments:
-                skipped_comments = sum(x.count for x in more_comments)
-                LOGGER.info(
-                    "Skipped %d MoreComments (%d comments) on %s",
-                    len(more_comments),
-                    skipped_comments,
-                    submission,
-                )
+    def _write(self, table: str, rows: list[tuple], awards: list[tuple]) -> None:
+        """Write rows of submissions or comments, by the writer thread if running."""
+        if self._writer_error:
+            raise RuntimeError("Writer stopped") from self._writer_error
+        if self._queue is None:
+            if table == "run_items":
+                self._save_journal(rows)
+            elif table == "submissions":
+                self._save_submissions(rows, awards)
+            else:
+                self._save_comments(rows, awards)
+            self.con.commit()
+        else:
+            self._queue.put((table, rows, awards))
+
+    def _save_journal(self, rows: list[tuple]) -> None:
+        """Update the state of submissions in the journal of the run."""
+        self.con.executemany(
+            """UPDATE run_items SET state = ?, error = ?, updated_at = ?
+    WHERE run_id = ? AND submission_id = ?""",
+            rows,
+        )
 
-            LOGGER.debug(
-                "Fetched %d comments on %d/%d submissions",
-                len(submission.comments.list()),
-                index + 1,
-                len(self.submissions),
+    def _journal(self, submission_id: str, state: str, error: str | None = None) -> None:
+        """Record the state of a submission in the journal, if a run is in progress."""
+        if self._run_id is not None:
+            self._write(
+                "run_items",
+                [(state, error, int(time.time()), self._run_id, submission_id)],
+                [],
             )
-            self.comments.extend(submission.comments.list())
 
-    def process_comments(self) -> None:
-        """Write comments to sql."""
-        LOGGER.debug("Processing %d comments", len(self.comments))
-        dcomments = []
+    def process_submissions(self) -> None:
+        """Write submissions file."""
+        LOGGER.debug("Processing %d submissions", len(self.submissions))
+        dsubmissions = []
         dawards = []
-        for c in self.comments:
-            dcomments.append(
-                (
-                    c.id,
-                    c.score,
-                    c.author.name if c.author else "[deleted]",
-                    c.link_id[3:],
-                    c.created_utc,
-                    c.parent_id,
-                    c.body,
-                    c.distinguished,
-                    c.removed,
-                    c.collapsed,
-                    c.locked,
-                    self._now,
-                )
+        for s in self.submissions:
+            row, awards = self._submission_rows(s, self._now)
+            dsubmissions.append(row)
+            dawards.extend(awards)
+        self._write("submissions", dsubmissions, dawards)
+
+    def fetch_comments_from_submissions(self, workers: int = 1, differential=False) -> int:
+        """Fetch and write the comments of the submissions, return their number.
+
+        :param workers: The number of submissions fetched at the same time
+        :param differential: Fetch only the comments not archived yet
+
+        """
+        fetch = self.fetch_new_comments if differential else self.fetch_comments
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            counts = list(
+                executor.map(lambda s: self._fetch_journaled(fetch, s), self.submissions)
             )
-            for award in c.all_awardings:
-                dawards.append(
-                    (
-                        award["id"],
-                        c.id,
-                        c.link_id[3:],
-                        award["name"],
-                        award["count"],
-                        award["award_type"],
-                        award["coin_price"],
-                        self._now,
-                    )
-                )
+        return sum(counts)
+
+    def _fetch_journaled(self, fetch, submission) -> int:
+        """Run fetch on a submission, recording its failure in the journal.
+
+        The submission is fetched again by the Reddit instance of the thread.
+        """
+        if self._writer_error:
+            # nothing fetched would be written
+            raise RuntimeError("Writer stopped") from self._writer_error
+        if submission.num_comments == 0:
+            self._journal(submission.id, "written")
+            return 0
+        listed = submission
+        submission = self._thread_reddit().submission(id=listed.id)
+        submission.comment_sort = listed.comment_sort
+        try:
+            return fetch(submission)
+        except Exception as e:
+            if self._writer_error:
+                raise
+            # any failure of a submission is journaled, not only the network ones
+            LOGGER.warning("Failed fetching comments on %s: %r", submission, e)
+            self._journal(submission.id, "failed", repr(e))
+            return 0
+
+    def _thread_reddit(self) -> Reddit:
+        """Return the Reddit instance of the current thread, praw is not thread-safe."""
+        reddit = getattr(self._local, "reddit", None)
+        if reddit is None:
+            reddit = self._local.reddit = Reddit(check_for_updates=False)
+        return reddit
+
+    def fetch_comments(self, submission) -> int:
+        """Fetch and write the comments of a submission, return their number."""
+        if submission.num_comments == 0:
+            self._journal(submission.id, "written")
+            return 0
+
+        more_comments = submission.comments.replace_more(limit=None)
+        if more_comments:
+            skipped_comments = sum(x.count for x in more_comments)
+            LOGGER.info(
+                "Skipped %d MoreComments (%d comments) on %s",
+                len(more_comments),
+                skipped_comments,
+                submission,
+            )
+
+        comments = submission.comments.list()
+        LOGGER.debug("Fetched %d comments on %s", len(comments), submission)
+        self.process_comments(comments, submission.id)
+        return len(comments)
+
+    def _comment_rows(self, c, last_update: int) -> tuple[tuple, list[tuple]]:
+        """Return the row of a comment, with the author name, and the rows of its awards."""
+        row = (
+            c.id,
+            c.score,
+            c.author.name if c.author else DELETED,
+            c.link_id[3:],
+            c.created_utc,
+            c.parent_id,
+            self._pack(c.body),
+            c.distinguished,
+            c.removed,
+            c.collapsed,
+            c.locked,
+            last_update,
+        )
+        awards = [
+            (
+                award["id"],
+                c.id,
+                c.link_id[3:],
+                award["name"],
+                award["count"],
+                award["award_type"],
+                award["coin_price"],
+                last_update,
+            )
+            for award in c.all_awardings
+        ]
+        return row, awards
+
+    def _save_comments(self, dcomments: list[tuple], dawards: list[tuple]) -> None:
+        """Insert or update comments and awards, unless stored ones are newer."""
+        last_active = {}
+        for index, row in enumerate(dcomments):
+            author_id = self._author_id(row[2])
+            last_active[author_id] = max(last_active.get(author_id, 0), row[4])
+            dcomments[index] = row[:2] + (author_id,) + row[3:]
         self.con.executemany(
             """INSERT INTO comments
-    (id, score, author, submission_id, created_utc, parent_id, body, distinguished, removed,
+    (id, score, author_id, submission_id, created_utc, parent_id, body, distinguished, removed,
     collapsed,  locked, last_update)
     VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     ON CONFLICT(id) DO UPDATE SET
     score=excluded.score, distinguished=excluded.distinguished, removed=excluded.removed,
     collapsed=excluded.collapsed, locked=excluded.locked, last_update=excluded.last_update,
-    parent_id=excluded.parent_id""",
+    parent_id=excluded.parent_id
+    WHERE excluded.last_update >= comments.last_update""",
             dcomments,
         )
         if dawards:
             LOGGER.debug("Processing %d comment awards", len(dawards))
             self.con.executemany(
-                """INSERT OR REPLACE INTO comments_awards
+                """INSERT INTO comments_awards
     (id, comment_id, submission_id, name, count, award_type, coin_price, last_update)
-    VALUES(?, ?, ?, ?, ?, ?, ?, ?)""",
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+    comment_id=excluded.comment_id, submission_id=excluded.submission_id,
+    name=excluded.name, count=excluded.count, award_type=excluded.award_type,
+    coin_price=excluded.coin_price, last_update=excluded.last_update
+    WHERE excluded.last_update >= comments_awards.last_update""",
                 dawards,
             )
+        self._update_last_active(last_active)
+        self._bump("comments", "authors")
 
-        self.con.commit()
+    def fetch_new_comments(self, submission) -> int:
+        """Fetch and write the new comments of a submission, return their number.
 
-    def run(self, refresh_old: int, days_old: int) -> None:
-        """Run stats and return the created Submission."""
+        Only the MoreComments with children not archived are expanded.
+        Archived comments returned with the new ones are written again.
+        """
+        more_comments = submission.comments.replace_more(limit=0)
+        with self._reader_lock:
+            known = {
+                row[0]
+                for row in self._reader.execute(
+                    "SELECT id FROM comments WHERE submission_id = ?", (submission.id,)
+                )
+            }
+        comments = []
+        pending = [submission.comments] + more_comments
+        # comment trees or MoreComments
+        while pending:
+            items = pending.pop()
+            if isinstance(items, MoreComments):
+                # children are empty for the continue this thread links
+                if items.children and known.issuperset(items.children):
+                    continue
+                items = items.comments()
+            for item in items:
+                if isinstance(item, MoreComments):
+                    pending.append(item)
+                else:
+                    comments.append(item)
+                    pending.append(item.replies)
+        LOGGER.debug("Fetched %d comments on %s", len(comments), submission)
+        self.process_comments(comments, submission.id)
+        return len(comments)
+
+    def process_comments(self, comments: list, submission_id: str | None = None) -> None:
+        """Write comments to sql, recording the progress of submission_id in the journal."""
+        LOGGER.debug("Processing %d comments", len(comments))
+        dcomments = []
+        dawards = []
+        for c in comments:
+            row, awards = self._comment_rows(c, self._now)
+            dcomments.append(row)
+            dawards.extend(awards)
+        if submission_id:
+            self._journal(submission_id, "expanded")
+        self._write("comments", dcomments, dawards)
+        if submission_id:
+            self._journal(submission_id, "written")
+
+    def import_dumps(self, filenames: list[str]) -> None:
+        """Load the submissions and comments of the subreddit from Pushshift dumps.
+
+        Dumps are read line by line, while the writer thread writes batches of
+        IMPORT_BATCH rows. The retrieval date of a row is its last_update:
+        rows already stored from a later fetch are kept.
+
+        :param filenames: RS_*.zst and RC_*.zst files, or their ndjson content
+
+        """
+        name = self.subreddit_name.lower()
+        # cheap check before parsing the json of a line
+        needle = re.compile(re.escape(name), re.IGNORECASE)
+        batches = {"submissions": ([], []), "comments": ([], [])}
+
+        def flush(table):
+            rows, awards = batches[table]
+            if rows:
+                self._write(table, rows, awards)
+                batches[table] = ([], [])
+
+        with self.writer():
+            for filename in filenames:
+                LOGGER.info("Importing %s", filename)
+                counts = {"submissions": 0, "comments": 0}
+                for line in read_dump(filename):
+                    if not needle.search(line):
+                        continue
+                    try:
+                        obj = json.loads(line)
+                    except ValueError:
+                        LOGGER.warning("Skipped invalid line in %s", filename)
+                        continue
+                    if (obj.get("subreddit") or "").lower() != name:
+                        continue
+                    item = dump_item(obj)
+                    last_update = int(
+                        obj.get("retrieved_on") or obj.get("retrieved_utc") or item.created_utc
+                    )
+                    if "link_id" in obj:
+                        table = "comments"
+                        row, awards = self._comment_rows(item, last_update)
+                    else:
+                        table = "submissions"
+                        row, awards = self._submission_rows(item, last_update)
+                    batches[table][0].append(row)
+                    batches[table][1].extend(awards)
+                    counts[table] += 1
+                    if len(batches[table][0]) >= IMPORT_BATCH:
+                        flush(table)
+                LOGGER.info(
+                    "Imported %d submissions and %d comments from %s",
+                    counts["submissions"],
+                    counts["comments"],
+                    filename,
+                )
+            # submissions before their comments, for the rollups
+            flush("submissions")
+            flush("comments")
+
+    def run(self, days_old: int, workers: int = 1, budget: int = REFRESH_BUDGET) -> None:
+        """Run stats and return the created Submission.
+
+        Submissions are listed and written first, with the journal of the run.
+        Their comments are then fetched in workers threads and written in the
+        writer thread, one submission at a time. The submissions failed or
+        pending in an unfinished run with the same arguments are taken over
+        by the next one, fetched again along with its own listing.
+        """
         LOGGER.info("Analyzing subreddit: %s", self.subreddit.display_name)
+        args = json.dumps({"days_old": days_old, "budget": budget}, sort_keys=True)
+        work = self._start_run(args, days_old, budget)
+        for pass_, submissions in self._take_over_runs(args, work).items():
+            work[pass_].extend(submissions)
+        with self.writer():
+            for pass_ in ("recent", "refresh"):
+                self.submissions = work[pass_]
+                if self.submissions:
+                    if not self.fetch_comments_from_submissions(
+                        workers, differential=pass_ == "refresh"
+                    ):
+                        LOGGER.info("No comments were found on the %s submissions.", pass_)
+        self._finish_run()
 
+    def _start_run(self, args: str, days_old: int, budget: int) -> dict[str, list]:
+        """List the submissions of a new run, return the ones to fetch the comments of, by pass.
+
+        The submissions are written before the journal of the run: if interrupted
+        in between, the next run starts over.
+        """
         # RECENT
         self.fetch_recent_submissions(days_old)
-        if not self.submissions:
+        recent = self.submissions
+        if not recent:
             LOGGER.warning("No submissions were found.")
-        else:
-            self.process_submissions()
-            self.fetch_comments_from_submissions()
-            if not self.comments:
-                LOGGER.warning("No comments were found.")
-            else:
-                self.process_comments()
-        #self.fetch_recent_traffics(days_old)
-        #if self.traffic:
-        #    self.process_traffics()
-        #else:
-        #    LOGGER.warning("No traffic were found.")
         # REFRESH
         self.submissions = []
-        self.comments = []
-        self.fetch_submissions_to_refresh(refresh_old, days_old)
-        if not self.submissions:
+        self.fetch_submissions_to_refresh(budget, days_old)
+        to_refresh = self.submissions
+        if not to_refresh:
             LOGGER.info("No submissions to refresh were found.")
-        else:
-            self.process_submissions()
-            self.fetch_comments_from_submissions()
-            if not self.comments:
-                LOGGER.info("No comments were found.")
-            else:
-                self.process_comments()
+        # threads without new comments are not fetched again
+        changed = [
+            s for s in to_refresh if s.num_comments != self._stored_num_comments.get(s.id)
+        ]
+        LOGGER.info(
+            "%d of %d submissions to refresh have new comments", len(changed), len(to_refresh)
+        )
 
-    def fetch_submissions_to_refresh(self, refresh_old: int, days_old: int) -> None:
-        """Fetch submissions in database to be refreshed.
+        self.submissions = recent + to_refresh
+        if self.submissions:
+            self.process_submissions()
+        now = int(time.time())
+        self._run_id = self.con.execute(
+            "INSERT INTO runs (args, started_at) VALUES (?, ?)", (args, now)
+        ).lastrowid
+        self.con.executemany(
+            """INSERT INTO run_items (run_id, submission_id, pass, state, updated_at)
+    VALUES (?, ?, ?, 'listed', ?)""",
+            [(self._run_id, s.id, "recent", now) for s in recent]
+            + [(self._run_id, s.id, "refresh", now) for s in changed],
+        )
+        self.con.commit()
+        return {"recent": recent, "refresh": changed}
 
-        :param refresh_old: The number of days submissions need to be older then to be refreshed
-        :param days_old: The number of days to include
+    def _take_over_runs(self, args: str, work: dict[str, list]) -> dict[str, list]:
+        """Move the submissions left by the unfinished runs with args to the current one.
 
+        Return the ones not already in work, by pass. The unfinished runs are
+        closed, keeping only their given up submissions for inspection.
         """
-
-        LOGGER.debug(
-            "Fetching submissions between %d and %d days old",
-            refresh_old,
-            refresh_old - days_old,
+        old_runs = [
+            row[0]
+            for row in self.con.execute(
+                "SELECT id FROM runs WHERE args = ? AND finished_at IS NULL AND id != ?",
+                (args, self._run_id),
+            )
+        ]
+        if not old_runs:
+            return {}
+        placeholders = ", ".join("?" * len(old_runs))
+        left = self.con.execute(
+            f"""SELECT submission_id, pass, MAX(attempts) FROM run_items
+    WHERE run_id IN ({placeholders}) AND state != 'written' AND attempts < ?
+    GROUP BY submission_id""",
+            (*old_runs, RUN_ATTEMPTS),
+        ).fetchall()
+        now = int(time.time())
+        # failed or pending: counted before the retry, that may crash the process too
+        self.con.executemany(
+            """INSERT INTO run_items (run_id, submission_id, pass, state, attempts, updated_at)
+    VALUES (?, ?, ?, 'listed', ?, ?)
+    ON CONFLICT (run_id, submission_id) DO UPDATE SET attempts = excluded.attempts""",
+            [(self._run_id, id_, pass_, attempts + 1, now) for id_, pass_, attempts in left],
         )
-        min_date = datetime.now(UTC).timestamp() - refresh_old * SECONDS_IN_DAY
-        max_date = min_date + SECONDS_IN_DAY * days_old
+        self.con.execute(
+            f"""DELETE FROM run_items WHERE run_id IN ({placeholders})
+    AND (state = 'written' OR attempts < ?)""",
+            (*old_runs, RUN_ATTEMPTS),
+        )
+        self.con.execute(
+            f"UPDATE runs SET finished_at = ? WHERE id IN ({placeholders})", (now, *old_runs)
+        )
+        self.con.commit()
+        listed = {s.id for submissions in work.values() for s in submissions}
+        passes = {id_: pass_ for id_, pass_, _ in left if id_ not in listed}
+        if not passes:
+            return {}
+        LOGGER.info("%d submissions left by unfinished runs", len(passes))
+        work = {"recent": [], "refresh": []}
+        ids = list(passes)
+        for start in range(0, len(ids), INFO_CHUNK):
+            chunk = ids[start : start + INFO_CHUNK]
+            for submission in self.reddit.info(fullnames=["t3_" + id_ for id_ in chunk]):
+                submission.comment_sort = "top"
+                work[passes.pop(submission.id)].append(submission)
+        if passes:
+            # deleted since listed: given up
+            LOGGER.info("%d submissions left were not found", len(passes))
+            self.con.executemany(
+                """UPDATE run_items SET state = 'failed', error = 'Not found', attempts = ?,
+    updated_at = ? WHERE run_id = ? AND submission_id = ?""",
+                [(RUN_ATTEMPTS, int(time.time()), self._run_id, id_) for id_ in passes],
+            )
+            self.con.commit()
+        return work
+
+    def _finish_run(self) -> None:
+        """Close the run if no submission is left to retry, dropping its written items."""
+        left = self.con.execute(
+            """SELECT COUNT(*) FROM run_items
+    WHERE run_id = ? AND state != 'written' AND attempts < ?""",
+            (self._run_id, RUN_ATTEMPTS),
+        ).fetchone()[0]
+        if left:
+            LOGGER.warning("%d submissions failed, retried by the next run", left)
+        else:
+            given_up = self.con.execute(
+                "SELECT COUNT(*) FROM run_items WHERE run_id = ? AND state != 'written'",
+                (self._run_id,),
+            ).fetchone()[0]
+            if given_up:
+                LOGGER.warning("%d submissions given up after %d attempts", given_up, RUN_ATTEMPTS)
+            self.con.execute(
+                "UPDATE runs SET finished_at = ? WHERE id = ?", (int(time.time()), self._run_id)
+            )
+            # the given up ones are kept for inspection
+            self.con.execute(
+                "DELETE FROM run_items WHERE run_id = ? AND state = 'written'", (self._run_id,)
+            )
+            self.con.commit()
+        self._run_id = None
+
+    def fetch_submissions_to_refresh(self, budget: int, days_old: int) -> None:
+        """Fetch the submissions in database whose refresh is due, most overdue first.
+
+        :param budget: The max number of submissions to refresh
+        :param days_old: The number of days of the recent submissions, fetched anyway
+
+        """
+        now = datetime.now(UTC).timestamp()
+        LOGGER.debug("Fetching up to %d submissions to refresh", budget)
         cur = self.con.cursor()
         res = cur.execute(
-            "SELECT id from submissions where last_update BETWEEN ? AND ?",
-            (min_date, max_date),
+            """SELECT id, num_comments FROM submissions
+    WHERE next_refresh_at IS NOT NULL AND next_refresh_at <= ?
+        AND created_utc <= ? AND created_utc > ?
+    ORDER BY next_refresh_at LIMIT ?""",
+            (now, now - SECONDS_IN_DAY * days_old, now - FREEZE_AGE, budget),
         )
-        for row in res:
-            self.submissions.append(self.reddit.submission(id=row[0]))
+        self._stored_num_comments = dict(res)
+        ids = list(self._stored_num_comments)
+        # fetched in bulk, missing if deleted
+        for start in range(0, len(ids), INFO_CHUNK):
+            chunk = ids[start : start + INFO_CHUNK]
+            self.submissions.extend(self.reddit.info(fullnames=["t3_" + id_ for id_ in chunk]))
+        missing = set(ids).difference(s.id for s in self.submissions)
+        if missing:
+            # never returned again: not scheduled anymore
+            LOGGER.info("%d submissions to refresh were not found", len(missing))
+            self.con.executemany(
+                "UPDATE submissions SET next_refresh_at = NULL WHERE id = ?",
+                [(id_,) for id_ in missing],
+            )
+            self.con.commit()
 
 
 def main() -> int:
     """Provide the entry point to the subreddit_stats command."""
     parser = arg_parser()
     parser.add_argument("subreddit", type=str, help="The subreddit to be analyzed")
-    parser.add_argument("days_old", type=int, help="Days to be fetched and refreshed")
-    parser.add_argument("refresh_old", type=int, help="Update contents older than")
+    parser.add_argument(
+        "days_old", type=int, nargs="?", help="Days of recent submissions to be fetched"
+    )
+    parser.add_argument(
+        "refresh_old",
+        type=int,
+        nargs="?",
+        help="Ignored: each submission is refreshed on its own schedule, see --budget",
+    )
+    parser.add_argument(
+        "--import",
+        dest="dumps",
+        nargs="+",
+        metavar="DUMP",
+        help="Load Pushshift RS_*.zst / RC_*.zst dumps instead of using the API"
+        " (.zst needs the dumps extra: pip install reddit-utilities[dumps])",
+    )
+    parser.add_argument(
+        "--enrich",
+        type=int,
+        default=0,
+        help="Max number of authors whose details are fetched, 0 skips it (default 0)",
+    )
+    parser.add_argument(
+        "--enrich-ttl",
+        type=int,
+        default=30,
+        help="Days before the details of an author are fetched again (default 30)",
+    )
+    parser.add_argument(
+        "--budget",
+        type=int,
+        default=REFRESH_BUDGET,
+        help="Max number of submissions refreshed, most overdue first (default %d)"
+        % REFRESH_BUDGET,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Submissions whose comments are fetched at the same time (default 4)",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Store bodies compressed from now on and compress the archived ones",
+    )
     parser.add_argument(
         "-v", "--verbose", action="count", default=0, help="Verbose level"
     )
@@ -357,8 +1359,22 @@ def main() -> int:
 
     LOGGER.addHandler(logging.StreamHandler())
 
+    if options.dumps or options.compress:
+        if zstandard is None and any(dump.endswith(".zst") for dump in options.dumps or []):
+            parser.error("--import of .zst files requires the zstandard package (dumps extra)")
+        srs = SubredditDump(options.subreddit, offline=True)
+        if options.compress:
+            srs.compress()
+        if options.dumps:
+            srs.import_dumps(options.dumps)
+        return 0
+    if options.days_old is None:
+        parser.error("days_old is required, unless --import or --compress")
+
     srs = SubredditDump(options.subreddit)
-    srs.run(options.refresh_old, options.days_old)
+    srs.run(options.days_old, options.workers, options.budget)
+    if options.enrich:
+        srs.enrich_authors(options.enrich, options.enrich_ttl)
     return 0
 
 
@@ -1,13 +1,21 @@
 """Utility to provide submission and comment statistics in a subreddit."""
 from argparse import ArgumentParser as arg_parser
 import csv
+import heapq
 import logging
+import os
+import sqlite3
+import tempfile
 import time
 from praw import Reddit
 
+from subreddit_archive import namespace_factory, register_body_text, view_query
+
 DAYS_IN_SECONDS = 60 * 60 * 24
 TOP_VALUES = {'all', 'day', 'month', 'week', 'year'}
 AGENT = 'python:reddit-stats:0.1 (by /u/timendum)'
+# Max number of run files opened at once while merging
+MERGE_FAN_IN = 128
 
 LOGGER = logging.getLogger(__file__)
 
@@ -22,18 +30,95 @@ class CustomDialect(csv.Dialect):
     quoting = csv.QUOTE_MINIMAL
 
 
+DB_SUBMISSIONS = """SELECT s.id, s.title, s.score,
+    (SELECT name FROM authors WHERE authors.id = s.author_id) AS author,
+    s.permalink, s.created_utc, s.domain, s.flair_class AS link_flair_css_class,
+    (SELECT COALESCE(SUM(a.count), 0) FROM submissions_awards AS a
+        WHERE a.submission_id = s.id) AS gilded,
+    s.num_comments, s.over_18
+FROM submissions AS s WHERE s.id IN (%s)"""
+
+DB_COMMENTS = """SELECT c.id, c.score, c.score AS ups, 0 AS downs,
+    (SELECT name FROM authors WHERE authors.id = c.author_id) AS author,
+    't3_' || c.submission_id AS link_id, c.created_utc, c.distinguished,
+    (SELECT COALESCE(SUM(a.count), 0) FROM comments_awards AS a
+        WHERE a.comment_id = c.id) AS gilded,
+    body_text(c.body) AS body
+FROM comments AS c WHERE c.submission_id IN (%s) ORDER BY c.created_utc"""
+
+
+def comment_row(c):
+    """Return the csv row of a comment."""
+    return [
+        c.id, c.score, c.ups, c.downs, c.author, c.link_id, c.created_utc,
+        c.distinguished, c.gilded, c.body
+    ]
+
+
+def write_run(directory, rows):
+    """Write rows, already sorted, to a new run file and return its name."""
+    fd, filename = tempfile.mkstemp(suffix='.csv', dir=directory)
+    with open(fd, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, dialect=CustomDialect)
+        writer.writerows(rows)
+    return filename
+
+
+def merge_runs(runs, directory):
+    """Yield the rows of sorted run files ordered by created_utc.
+
+    Runs are merged in passes of at most MERGE_FAN_IN files, to keep the
+    number of open files bounded.
+
+    """
+    runs = list(runs)
+    while len(runs) > MERGE_FAN_IN:
+        merged = []
+        for start in range(0, len(runs), MERGE_FAN_IN):
+            group = runs[start:start + MERGE_FAN_IN]
+            merged.append(write_run(directory, _merge_files(group)))
+            for run in group:
+                os.remove(run)
+        runs = merged
+    yield from _merge_files(runs)
+
+
+def _merge_files(runs):
+    """Heap merge run files by created_utc."""
+    files = [open(run, newline='', encoding='utf-8') for run in runs]
+    try:
+        readers = [csv.reader(f, dialect=CustomDialect) for f in files]
+        yield from heapq.merge(*readers, key=lambda row: float(row[6]))
+    finally:
+        for f in files:
+            f.close()
+
+
 class SubredditStats(object):
     """Contain all the functionality of the subreddit_stats command."""
 
-    def __init__(self, subreddit):
+    def __init__(self, subreddit, external_sort=False, from_db=False):
         """Initialize the SubredditStats instance with config options."""
         self.comments = []
+        self.external_sort = external_sort
+        self.runs = []
+        self.run_dir = None
         self.submissions = []
         self.min_date = 0
         # less then 7 days
         self.max_date = time.time()  # - DAYS_IN_SECONDS * 7
-        self.reddit = Reddit(check_for_updates=False, user_agent=AGENT)
-        self.subreddit = self.reddit.subreddit(subreddit)
+        if from_db:
+            # read the archive of subreddit-sql.py, no API calls
+            self.reddit = None
+            self.subreddit = subreddit
+            self.con = sqlite3.connect('file:%s.db?mode=ro' % subreddit,
+                                       uri=True)
+            self.con.row_factory = namespace_factory
+            register_body_text(self.con)
+        else:
+            self.con = None
+            self.reddit = Reddit(check_for_updates=False, user_agent=AGENT)
+            self.subreddit = self.reddit.subreddit(subreddit)
 
     def fetch_recent_submissions(self, max_duration):
         """Fetch recent submissions in subreddit with boundaries.
@@ -66,6 +151,17 @@ class SubredditStats(object):
         for submission in self.subreddit.top(limit=None, time_filter=top):
             self.submissions.append(submission)
 
+    def fetch_db_submissions(self, view):
+        """Fetch the submissions of a view from the archive.
+
+        :param view: The number of latest days or one of TOP_VALUES
+
+        """
+        LOGGER.debug('Fetching archived submissions with view=%s', view)
+        self.view_query = view_query(view, self.max_date)
+        query, params = self.view_query
+        self.submissions.extend(self.con.execute(DB_SUBMISSIONS % query, params))
+
     def fetch_submissions(self, submissions_callback, *args):
         """Wrap the submissions_callback function."""
         submissions_callback(*args)
@@ -83,6 +179,14 @@ class SubredditStats(object):
         """Write comments file."""
         LOGGER.debug('Fetching comments on %d submissions',
                      len(self.submissions))
+        if self.con:
+            # already sorted, streamed while writing
+            query, params = self.view_query
+            self.comments = self.con.execute(DB_COMMENTS % query, params)
+            return
+        if self.external_sort:
+            self.fetch_comments_to_runs()
+            return
 
         for index, submission in enumerate(self.submissions):
             if submission.num_comments == 0:
@@ -102,6 +206,33 @@ class SubredditStats(object):
 
         self.comments.sort(key=lambda x: x.created_utc)
 
+    def fetch_comments_to_runs(self):
+        """Fetch comments, spilling a sorted run file for every submission.
+
+        A fresh submission object is used for each thread, so its comments
+        can be released as soon as they are on disk.
+
+        """
+        self.run_dir = tempfile.TemporaryDirectory()
+        for index, listed in enumerate(self.submissions):
+            if listed.num_comments == 0:
+                continue
+            submission = self.reddit.submission(id=listed.id)
+            submission.comment_sort = 'top'
+
+            more_comments = submission.comments.replace_more()
+            if more_comments:
+                skipped_comments = sum(x.count for x in more_comments)
+                LOGGER.debug('Skipped %d MoreComments (%d comments)',
+                             len(more_comments), skipped_comments)
+
+            comments = submission.comments.list()
+            comments.sort(key=lambda x: x.created_utc)
+            self.runs.append(
+                write_run(self.run_dir.name, (comment_row(c) for c in comments)))
+            LOGGER.debug('Spilled %d comments on %d/%d submissions',
+                         len(comments), index + 1, len(self.submissions))
+
     def process_submissions(self):
         """Write submissions file."""
         filename = '%s-submissions.csv' % self.base_filename
@@ -131,11 +262,13 @@ class SubredditStats(object):
                 'd', 'score', 'ups', 'downs', 'author', 'link_id',
                 'created_utc', 'distinguished', 'gilded', 'body'
             ])
+            if self.run_dir:
+                writer.writerows(merge_runs(self.runs, self.run_dir.name))
+                self.run_dir.cleanup()
+                self.run_dir = None
+                self.runs = []
             for c in self.comments:
-                writer.writerow([
-                    c.id, c.score, c.ups, c.downs, c.author, c.link_id,
-                    c.created_utc, c.distinguished, c.gilded, c.body
-                ])
+                writer.writerow(comment_row(c))
         return filename
 
     def publish_results(self, view):
@@ -148,9 +281,13 @@ class SubredditStats(object):
 
     def run(self, view):
         """Run stats and return the created Submission."""
-        LOGGER.info('Analyzing subreddit: %s', self.subreddit.display_name)
+        LOGGER.info('Analyzing subreddit: %s', self.subreddit)
 
-        if view in TOP_VALUES:
+        if self.con:
+            callback = self.fetch_db_submissions
+            if view not in TOP_VALUES:
+                view = int(view)
+        elif view in TOP_VALUES:
             callback = self.fetch_top_submissions
         else:
             callback = self.fetch_recent_submissions
@@ -179,6 +316,14 @@ def main():
         type=int,
         default=0,
         help='0 for disabled, 1 for info, more for debug')
+    parser.add_argument(
+        '--external-sort',
+        action='store_true',
+        help='Sort comments on disk, to export any view in bounded memory')
+    parser.add_argument(
+        '--from-db',
+        action='store_true',
+        help='Read from the SUBREDDIT.db archive of subreddit-sql.py')
 
     options = parser.parse_args()
 
@@ -190,7 +335,8 @@ def main():
         LOGGER.setLevel(logging.NOTSET)
     LOGGER.addHandler(logging.StreamHandler())
 
-    srs = SubredditStats(options.subreddit)
+    srs = SubredditStats(options.subreddit, options.external_sort,
+                         options.from_db)
     files = srs.run(options.view)
     if files:
         print('Written files: %s' % ' '.join(files))
@@ -0,0 +1,369 @@
+"""Read queries over the sqlite archive written by subreddit-sql.py."""
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import SimpleNamespace
+import logging
+import queue
+import sqlite3
+import struct
+import threading
+import zlib
+
+LOGGER = logging.getLogger(__file__)
+
+SECONDS_IN_DAY = 60 * 60 * 24
+# Days covered by the top views, None for no limit
+TOP_DAYS = {"all": None, "day": 1, "month": 30, "week": 7, "year": 365}
+# Max number of items in a reddit listing
+LISTING_LIMIT = 1000
+
+# Results kept by the cache of an Archive
+CACHE_SIZE = 128
+# Max number of rows of a page
+PAGE_LIMIT = 500
+# Id of the zdict row before the deflate data of a compressed body
+ZDICT_HEADER = struct.Struct(">H")
+
+AUTHOR_SQL = "(SELECT name FROM authors WHERE authors.id = {0}.author_id) AS author"
+
+SUBMISSION_COLUMNS = f"""s.id, s.title, s.score, s.upvote_ratio, {AUTHOR_SQL.format("s")},
+    s.permalink, s.created_utc, s.domain, body_text(s.selftext) AS selftext, s.link AS url,
+    s.flair_text, s.flair_class, s.num_comments, s.over_18, s.distinguished, s.removed, s.locked"""
+
+COMMENT_COLUMNS = f"""c.id, c.score, {AUTHOR_SQL.format("c")}, c.submission_id,
+    c.created_utc, c.parent_id, body_text(c.body) AS body, c.distinguished, c.removed,
+    c.collapsed, c.locked,
+    '/comments/' || c.submission_id || '/_/' || c.id || '/' AS permalink"""
+
+TOP_COMMENTS = f"""SELECT {COMMENT_COLUMNS},
+    (SELECT title FROM submissions WHERE submissions.id = c.submission_id) AS title
+FROM comments AS c WHERE c.created_utc >= ? AND c.created_utc < ? AND c.score >= ?
+ORDER BY c.score DESC LIMIT ?"""
+
+SUBMISSION = f"SELECT {SUBMISSION_COLUMNS} FROM submissions AS s WHERE s.id = ?"
+
+THREAD_COMMENTS = f"""SELECT {COMMENT_COLUMNS}
+FROM comments AS c WHERE c.submission_id = ? ORDER BY c.score DESC"""
+
+AUTHOR_HISTORY = f"""SELECT 'submission' AS kind, s.id, s.id AS submission_id, s.title,
+    NULL AS body, s.score, s.created_utc, s.permalink
+FROM submissions AS s WHERE s.author_id = (SELECT id FROM authors WHERE name = :name)
+UNION ALL
+SELECT 'comment', c.id, c.submission_id, NULL, body_text(c.body), c.score, c.created_utc,
+    '/comments/' || c.submission_id || '/_/' || c.id || '/'
+FROM comments AS c WHERE c.author_id = (SELECT id FROM authors WHERE name = :name)
+ORDER BY created_utc DESC LIMIT :limit"""
+
+SUBMISSIONS_PAGE = f"""SELECT {SUBMISSION_COLUMNS}
+FROM submissions AS s WHERE s.created_utc >= ? AND s.created_utc < ?
+    AND (s.created_utc, s.id) < (?, ?)
+ORDER BY s.created_utc DESC, s.id DESC LIMIT ?"""
+
+COMMENTS_PAGE = f"""SELECT {COMMENT_COLUMNS}
+FROM comments AS c WHERE c.created_utc >= ? AND c.created_utc < ?
+    AND (c.created_utc, c.id) < (?, ?)
+ORDER BY c.created_utc DESC, c.id DESC LIMIT ?"""
+
+SEARCH_PAGE = f"""SELECT {SUBMISSION_COLUMNS}
+FROM submissions AS s
+WHERE (s.title LIKE ? ESCAPE '\\' OR body_text(s.selftext) LIKE ? ESCAPE '\\')
+    AND (s.created_utc, s.id) < (?, ?)
+ORDER BY s.created_utc DESC, s.id DESC LIMIT ?"""
+
+AUTHOR_STATS = """SELECT a.name, a.created_utc, a.comment_karma, a.link_karma, a.is_suspended,
+    a.last_active, COALESCE(SUM(d.submissions), 0) AS submissions,
+    COALESCE(SUM(d.comments), 0) AS comments, MIN(d.day) AS first_day,
+    COUNT(d.day) AS active_days
+FROM authors AS a LEFT JOIN author_daily AS d ON d.author_id = a.id
+WHERE a.name = ? GROUP BY a.id"""
+
+FLAIR_LEADERS = f"""SELECT * FROM (
+    SELECT {SUBMISSION_COLUMNS},
+        ROW_NUMBER() OVER (PARTITION BY s.flair_text ORDER BY s.score DESC) AS rank
+    FROM submissions AS s WHERE s.created_utc >= ? AND s.created_utc < ?)
+WHERE rank <= ? ORDER BY flair_text, rank"""
+
+
+def namespace_factory(cursor, row):
+    """Return sql rows as objects, like the ones from praw."""
+    return SimpleNamespace(**{column[0]: value for column, value in zip(cursor.description, row)})
+
+
+def view_query(view, now: float) -> tuple[str, tuple]:
+    """Return the sql selecting the ids of the submissions in a view.
+
+    :param view: The number of latest days or one of TOP_DAYS
+    :param now: The end of the view
+    :returns: The query and its parameters.
+
+    """
+    if view in TOP_DAYS:
+        if TOP_DAYS[view] is None:
+            return "SELECT id FROM submissions ORDER BY score DESC LIMIT %d" % LISTING_LIMIT, ()
+        return (
+            "SELECT id FROM submissions WHERE created_utc >= ? "
+            "ORDER BY score DESC LIMIT %d" % LISTING_LIMIT,
+            (now - SECONDS_IN_DAY * TOP_DAYS[view],),
+        )
+    return (
+        "SELECT id FROM submissions WHERE created_utc > ? AND created_utc <= ?",
+        (now - SECONDS_IN_DAY * int(view), now),
+    )
+
+
+def unpack_text(value, zdicts: dict):
+    """Return the text of a body, decompressing it if stored compressed.
+
+    :param value: A body or selftext column
+    :param zdicts: The dictionaries of the archive by id
+
+    """
+    if not isinstance(value, bytes):
+        return value
+    (zdict_id,) = ZDICT_HEADER.unpack_from(value)
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=zdicts[zdict_id])
+    data = decompressor.decompress(value[ZDICT_HEADER.size :]) + decompressor.flush()
+    return data.decode("utf-8")
+
+
+def register_body_text(con: sqlite3.Connection) -> None:
+    """Add the body_text() sql function, returning bodies as text, to con."""
+    zdicts = {}
+
+    def body_text(value):
+        if isinstance(value, bytes) and ZDICT_HEADER.unpack_from(value)[0] not in zdicts:
+            # dictionaries are read when first needed, old archives have none
+            cur = con.cursor()
+            # plain tuples, whatever the row_factory of con
+            cur.row_factory = None
+            zdicts.update(cur.execute("SELECT id, data FROM zdict").fetchall())
+        return unpack_text(value, zdicts)
+
+    con.create_function("body_text", 1, body_text, deterministic=True)
+
+
+def clamp(limit: int) -> int:
+    """Return limit within 1 and PAGE_LIMIT."""
+    return max(1, min(limit, PAGE_LIMIT))
+
+
+def page(rows: list, limit: int) -> tuple[list, str | None]:
+    """Split the limit + 1 rows of a keyset query in a page and its cursor."""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, "%s:%s" % (rows[-1].created_utc, rows[-1].id)
+
+
+def parse_cursor(cursor: str | None) -> tuple:
+    """Return the (created_utc, id) of a page cursor, the start if None."""
+    if not cursor:
+        # after any row
+        return float("inf"), ""
+    created_utc, _, row_id = cursor.partition(":")
+    return float(created_utc), row_id
+
+
+class Archive(object):
+    """Index-backed queries over {subreddit}.db, with a result cache.
+
+    Cached results are returned while the version of the tables they read,
+    counted by every write of subreddit-sql.py, is unchanged. Archives
+    older than the versions table are never cached. Results are shared
+    between callers and must not be modified.
+
+    Queries can run from many threads, each on one of the connections.
+    """
+
+    def __init__(self, subreddit: str, cache_size: int = CACHE_SIZE, connections: int = 1):
+        self._pool = queue.Queue()
+        for _ in range(connections):
+            # handed between threads, used by one at a time
+            con = sqlite3.connect(
+                f"file:{subreddit}.db?mode=ro", uri=True, check_same_thread=False
+            )
+            con.row_factory = namespace_factory
+            register_body_text(con)
+            self._pool.put(con)
+        self.connections = connections
+        self.cache_size = cache_size
+        # key -> (watermark, result), least recently used first
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        for _ in range(self.connections):
+            self._pool.get().close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection of the pool."""
+        con = self._pool.get()
+        try:
+            yield con
+        finally:
+            self._pool.put(con)
+
+    def watermark(self, tables: tuple[str, ...]) -> tuple | None:
+        """Return the write version of each table, None without versions."""
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.row_factory = None
+            try:
+                versions = dict(cur.execute("SELECT name, version FROM versions").fetchall())
+            except sqlite3.OperationalError:
+                return None
+        return tuple(versions.get(table, 0) for table in tables)
+
+    def clear(self) -> None:
+        """Empty the cache."""
+        with self._lock:
+            self._cache.clear()
+
+    def _cached(self, key: tuple, tables: tuple[str, ...], compute):
+        """Return the cached result of key, computing it if missing or stale.
+
+        compute is called with a connection of the pool.
+        """
+        watermark = self.watermark(tables)
+        if watermark is None:
+            with self.connection() as con:
+                return compute(con)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == watermark:
+                self._cache.move_to_end(key)
+                return cached[1]
+        LOGGER.debug("Computing %s", key)
+        with self.connection() as con:
+            result = compute(con)
+        with self._lock:
+            self._cache[key] = (watermark, result)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def top_comments(self, min_date: int, max_date: int, limit: int = 100, min_score: int = 0):
+        """Return the best comments created between min_date and max_date.
+
+        :param min_date: The oldest creation date included
+        :param max_date: The creation date excluded
+        :param limit: The max number of comments
+        :param min_score: The min score of a comment
+
+        """
+        params = (min_date, max_date, min_score, clamp(limit))
+        return self._cached(
+            ("top_comments",) + params,
+            ("comments", "submissions"),
+            lambda con: con.execute(TOP_COMMENTS, params).fetchall(),
+        )
+
+    def thread(self, submission_id: str):
+        """Return a submission with its comment tree, None if not archived.
+
+        Top level comments are in submission.comments, the replies of each
+        comment in comment.replies, best first.
+        """
+
+        def compute(con):
+            submission = con.execute(SUBMISSION, (submission_id,)).fetchone()
+            if submission is None:
+                return None
+            comments = con.execute(THREAD_COMMENTS, (submission_id,)).fetchall()
+            by_id = {comment.id: comment for comment in comments}
+            submission.comments = []
+            for comment in comments:
+                comment.replies = []
+            for comment in comments:
+                parent = by_id.get(comment.parent_id[3:]) if comment.parent_id else None
+                if parent is None:
+                    # top level, or reply to a comment not archived
+                    submission.comments.append(comment)
+                else:
+                    parent.replies.append(comment)
+            return submission
+
+        return self._cached(("thread", submission_id), ("submissions", "comments"), compute)
+
+    def author_history(self, name: str, limit: int = 100):
+        """Return the latest submissions and comments of an author.
+
+        Rows have a kind, submission or comment.
+        """
+        limit = clamp(limit)
+        params = {"name": name, "limit": limit}
+        return self._cached(
+            ("author_history", name, limit),
+            ("submissions", "comments", "authors"),
+            lambda con: con.execute(AUTHOR_HISTORY, params).fetchall(),
+        )
+
+    def flair_leaders(self, min_date: int, max_date: int, limit: int = 10):
+        """Return the best submissions of each flair, by flair and rank.
+
+        :param min_date: The oldest creation date included
+        :param max_date: The creation date excluded
+        :param limit: The max number of submissions for each flair
+
+        """
+        params = (min_date, max_date, clamp(limit))
+        return self._cached(
+            ("flair_leaders",) + params,
+            ("submissions",),
+            lambda con: con.execute(FLAIR_LEADERS, params).fetchall(),
+        )
+
+    def submissions(self, min_date: int, max_date: int, limit: int = 100, cursor=None):
+        """Return a page of the submissions created in a window, newest first.
+
+        :param min_date: The oldest creation date included
+        :param max_date: The creation date excluded
+        :param limit: The max number of submissions
+        :param cursor: The cursor returned with the previous page
+        :returns: The submissions and the cursor of the next page, None at the end.
+
+        """
+        limit = clamp(limit)
+        params = (min_date, max_date) + parse_cursor(cursor) + (limit + 1,)
+        return self._cached(
+            ("submissions",) + params,
+            ("submissions",),
+            lambda con: page(con.execute(SUBMISSIONS_PAGE, params).fetchall(), limit),
+        )
+
+    def comments(self, min_date: int, max_date: int, limit: int = 100, cursor=None):
+        """Return a page of the comments created in a window, newest first.
+
+        Parameters and result as submissions.
+        """
+        limit = clamp(limit)
+        params = (min_date, max_date) + parse_cursor(cursor) + (limit + 1,)
+        return self._cached(
+            ("comments",) + params,
+            ("comments",),
+            lambda con: page(con.execute(COMMENTS_PAGE, params).fetchall(), limit),
+        )
+
+    def search(self, text: str, limit: int = 100, cursor=None):
+        """Return a page of the submissions containing text, newest first.
+
+        Parameters and result as submissions.
+        """
+        limit = clamp(limit)
+        pattern = "%%%s%%" % text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        params = (pattern, pattern) + parse_cursor(cursor) + (limit + 1,)
+        return self._cached(
+            ("search",) + params,
+            ("submissions",),
+            lambda con: page(con.execute(SEARCH_PAGE, params).fetchall(), limit),
+        )
+
+    def author_stats(self, name: str):
+        """Return the details and the activity totals of an author, None if unknown."""
+        return self._cached(
+            ("author_stats", name),
+            ("submissions", "comments", "authors"),
+            lambda con: con.execute(AUTHOR_STATS, (name,)).fetchone(),
+        )
@@ -1,13 +1,57 @@
 from argparse import ArgumentParser as arg_parser
 import csv
+import heapq
+import json
 import logging
+import os
+import re
+import sys
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from io import StringIO
 
 from praw import Reddit
+from praw.models import MoreComments
 
 AGENT = 'python:thread-cloud:0.1 (by /u/timendum)'
 
+CSV_HEADER = [
+    'id', 'score', 'author', 'link_id', 'created_utc', 'controversiality',
+    'edited', 'top_level', 'stickied', 'distinguished', 'gilded', 'parent', 'body'
+]
+
+DEFAULT_FILENAMES = {'text': '%s.txt', 'csv': '%s.csv', 'cloud': '%s-cloud.csv'}
+
+# Words of at least two letters, after removing links
+TOKEN_RE = re.compile(r'[^\W\d_]{2,}')
+URL_RE = re.compile(r'https?://\S+')
+
+STOPWORDS = {
+    'it': frozenset('''
+        a ad agli ai al alla alle allo anche avere aveva avevo c che chi ci come
+        con cosa cui da dal dalla dei del dell della delle dello di dove e ed
+        era essere fa fare gli ha hai hanno ho il in io la le lei li lo loro lui
+        ma me mi mia mio ne nei nel nella nelle no noi non nostro o per perche
+        perché più poi può quale quando quanto quella quelle quello questa
+        queste questi questo se sei si sia siamo sono sta su sua sue sui sul
+        sulla suo te ti tra tu tua tuo tutti tutto un una uno va vi voi è
+        '''.split()),
+    'en': frozenset('''
+        a about after all also am an and any are as at be because been but by
+        can could did do does don for from had has have he her him his how if
+        in into is it its just like me more my no not now of on one only or
+        other our out so some than that the their them then there these they
+        this to too up us was we were what when which who will with would you
+        your
+        '''.split()),
+}
+
+# Attributes needed to rebuild a pending MoreComments
+MORE_ATTRS = ('id', 'name', 'count', 'depth', 'parent_id', 'children')
+
 
 class CustomDialect(csv.Dialect):
     """Describe the usual properties of Excel-generated CSV files."""
@@ -22,8 +66,9 @@ class CustomDialect(csv.Dialect):
 logger = logging.getLogger(__file__)
 
 
-def get_comments(submission_id):
-    reddit = Reddit(check_for_updates=False, user_agent=AGENT)
+def get_comments(submission_id, reddit=None):
+    if not reddit:
+        reddit = Reddit(check_for_updates=False, user_agent=AGENT)
     submission = reddit.submission(id=submission_id)
     more_comments = submission.comments.replace_more(limit=None)
     if more_comments:
@@ -40,35 +85,328 @@ def extract_bodies(comments):
     return bodies
 
 
-def to_csv(comments):
+def csv_row(c):
+    return [
+        c.id, c.score, c.author, c.link_id,
+        datetime.utcfromtimestamp(c.created_utc), c.controversiality,
+        datetime.utcfromtimestamp(c.edited)
+        if c.edited else c.edited, (c.parent_id == c.link_id), c.stickied,
+        c.distinguished, c.gilded,
+        '' if c.parent_id == c.link_id  else c.parent_id[3:],
+        c.body
+    ]
+
+
+def to_csv(comments, header=True):
     f = StringIO()
     writer = csv.writer(f, dialect=CustomDialect)
-    writer.writerow([
-        'id', 'score', 'author', 'link_id', 'created_utc', 'controversiality',
-        'edited', 'top_level', 'stickied', 'distinguished', 'gilded', 'parent', 'body'
-    ])
+    if header:
+        writer.writerow(CSV_HEADER)
     for c in comments:
-        writer.writerow([
-            c.id, c.score, c.author, c.link_id,
-            datetime.utcfromtimestamp(c.created_utc), c.controversiality,
-            datetime.utcfromtimestamp(c.edited)
-            if c.edited else c.edited, (c.parent_id == c.link_id), c.stickied,
-            c.distinguished, c.gilded,
-            '' if c.parent_id == c.link_id  else c.parent_id[3:],
-            c.body
-        ])
+        writer.writerow(csv_row(c))
     output = f.getvalue()
     f.close()
     return output
 
 
+def render(command, comments, header=True):
+    """Return the output of command for the comments."""
+    if command == 'text':
+        return '\n'.join(extract_bodies(comments))
+    return to_csv(comments, header)
+
+
+def read_ids(source):
+    """Return the thread ids in source, one per line ('-' for stdin)."""
+    if source == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(source, encoding='utf8') as f:
+            lines = f.readlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+def export_batch(ids, command, filename=None, workers=4, cloud_options=None):
+    """Export many threads, expanding them concurrently.
+
+    Every worker has its own Reddit instance: praw sessions are not
+    thread-safe. With filename every thread is written in a single file, one
+    after the other (for cloud: the terms of all threads are counted
+    together), otherwise each thread gets its own file.
+    cloud_options are top, stopwords and ngrams of the cloud command.
+    Return the written files.
+    """
+    local = threading.local()
+
+    def fetch(submission_id):
+        if not hasattr(local, 'reddit'):
+            local.reddit = Reddit(check_for_updates=False, user_agent=AGENT)
+        try:
+            return get_comments(submission_id, local.reddit)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Skipped %s', submission_id)
+            return None
+
+    files = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(fetch, ids)
+        if command == 'cloud':
+            top, stopwords, ngrams = cloud_options
+            counter = TermCounter(top)
+            for submission_id, comments in zip(ids, results):
+                if comments is None:
+                    continue
+                if not filename:
+                    counter = TermCounter(top)
+                count_terms(comments, counter, stopwords, ngrams)
+                if not filename:
+                    output_file = DEFAULT_FILENAMES[command] % submission_id
+                    write_cloud(counter, output_file)
+                    files.append(output_file)
+                    logger.info('Written %s', output_file)
+            if filename:
+                write_cloud(counter, filename)
+                files.append(filename)
+        elif filename:
+            with open(filename, 'w', encoding='utf8') as fileout:
+                first = True
+                for submission_id, comments in zip(ids, results):
+                    if comments is None:
+                        continue
+                    if not first and command == 'text':
+                        fileout.write('\n')
+                    fileout.write(render(command, comments, header=first))
+                    first = False
+                    logger.info('Written %s', submission_id)
+            files.append(filename)
+        else:
+            for submission_id, comments in zip(ids, results):
+                if comments is None:
+                    continue
+                output_file = DEFAULT_FILENAMES[command] % submission_id
+                with open(output_file, 'w', encoding='utf8') as fileout:
+                    fileout.write(render(command, comments))
+                files.append(output_file)
+                logger.info('Written %s', output_file)
+    return files
+
+
+class CountMinSketch(object):
+    """Approximate counter in fixed memory, it never underestimates."""
+
+    def __init__(self, width=2 ** 18, depth=4):
+        self.width = width
+        self.tables = [array('I', [0]) * width for _ in range(depth)]
+
+    def add(self, term):
+        """Count term once and return its estimated count."""
+        value = hash(term)
+        step = (value >> 32) | 1
+        indexes = [(value + row * step) % self.width
+                   for row in range(len(self.tables))]
+        # conservative update: only raise the counters at the minimum
+        count = min(table[index]
+                    for table, index in zip(self.tables, indexes)) + 1
+        for table, index in zip(self.tables, indexes):
+            if table[index] < count:
+                table[index] = count
+        return count
+
+
+class TermCounter(object):
+    """Keep the most frequent terms, in memory bounded by top."""
+
+    def __init__(self, top=200):
+        if top < 1:
+            raise ValueError('top must be at least 1')
+        self.top = top
+        self.sketch = CountMinSketch()
+        # estimated counts of the current top terms
+        self.counts = {}
+        # (count, term) of the top terms, stale entries are skipped
+        self.heap = []
+
+    def add(self, term):
+        count = self.sketch.add(term)
+        if term in self.counts or len(self.counts) < self.top:
+            self.counts[term] = count
+            heapq.heappush(self.heap, (count, term))
+        else:
+            while self.heap[0][0] != self.counts.get(self.heap[0][1]):
+                heapq.heappop(self.heap)
+            if count <= self.heap[0][0]:
+                return
+            _, evicted = heapq.heapreplace(self.heap, (count, term))
+            del self.counts[evicted]
+            self.counts[term] = count
+        if len(self.heap) > 4 * self.top:
+            self.heap = [(count, term) for term, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def most_common(self):
+        """Return the top terms and their counts, most frequent first."""
+        return sorted(self.counts.items(), key=lambda x: (-x[1], x[0]))
+
+
+def extract_terms(body, stopwords=frozenset(), ngrams=1):
+    """Yield the words of body and the sequences of up to ngrams words."""
+    words = [word for word in TOKEN_RE.findall(URL_RE.sub(' ', body.lower()))
+             if word not in stopwords]
+    for size in range(1, ngrams + 1):
+        for start in range(len(words) - size + 1):
+            yield ' '.join(words[start:start + size])
+
+
+def count_terms(comments, counter, stopwords=frozenset(), ngrams=1):
+    """Add the terms of every comment to counter."""
+    for comment in comments:
+        for term in extract_terms(comment.body, stopwords, ngrams):
+            counter.add(term)
+    return counter
+
+
+def write_cloud(counter, filename):
+    """Write the top terms in filename, as json if it ends with .json."""
+    if filename.endswith('.json'):
+        with open(filename, 'w', encoding='utf8') as fileout:
+            json.dump([{'term': term, 'count': count}
+                       for term, count in counter.most_common()],
+                      fileout, ensure_ascii=False, indent=1)
+        return
+    with open(filename, 'w', newline='', encoding='utf8') as fileout:
+        writer = csv.writer(fileout, dialect=CustomDialect)
+        writer.writerow(['term', 'count'])
+        writer.writerows(counter.most_common())
+
+
+def stream_cloud(submission_id, counter, stopwords=frozenset(), ngrams=1):
+    """Count the terms of a thread while its tree is expanded."""
+    reddit = Reddit(check_for_updates=False, user_agent=AGENT)
+    submission = reddit.submission(id=submission_id)
+    for comments, _ in expand_comments(submission):
+        count_terms(comments, counter, stopwords, ngrams)
+    return counter
+
+
+def walk(items, pending):
+    """Return the comments in items and in their replies.
+
+    MoreComments found along the way are appended to pending.
+    """
+    comments = []
+    stack = list(reversed(list(items)))
+    while stack:
+        item = stack.pop()
+        if isinstance(item, MoreComments):
+            pending.append(item)
+            continue
+        comments.append(item)
+        stack.extend(reversed(list(item.replies)))
+    return comments
+
+
+def expand_comments(submission, pending=None):
+    """Yield the comments of a submission in batches, one per request.
+
+    After every batch, pending holds the MoreComments still to be resolved:
+    pass it back to resume the expansion.
+    """
+    if pending is None:
+        pending = deque()
+        yield walk(submission.comments, pending), pending
+    while pending:
+        more = pending[0]
+        comments = walk(more.comments(), pending)
+        pending.popleft()
+        yield comments, pending
+
+
+def save_checkpoint(checkpoint_file, offset, pending):
+    """Atomically write the resume point of a streaming export."""
+    checkpoint = {
+        'offset': offset,
+        'pending': [{attr: getattr(more, attr) for attr in MORE_ATTRS}
+                    for more in pending]
+    }
+    with open(checkpoint_file + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+def load_checkpoint(filename, checkpoint_file, reddit, submission):
+    """Restore an interrupted export.
+
+    Cut the output back to the last complete batch, return the ids
+    already written and the MoreComments still to be resolved.
+    """
+    with open(checkpoint_file, encoding='utf8') as f:
+        checkpoint = json.load(f)
+    with open(filename, 'r+b') as f:
+        f.truncate(checkpoint['offset'])
+    with open(filename, newline='', encoding='utf8') as f:
+        reader = csv.reader(f, dialect=CustomDialect)
+        next(reader)  # header
+        seen = {row[0] for row in reader}
+    pending = deque()
+    for data in checkpoint['pending']:
+        more = MoreComments(reddit, data)
+        more.submission = submission
+        pending.append(more)
+    return seen, pending
+
+
+def stream_csv(submission_id, filename, reddit=None):
+    """Write comments to filename while the tree is expanded.
+
+    A checkpoint is kept next to the output, an interrupted export
+    restarts from it without fetching again what was already written.
+    """
+    if not reddit:
+        reddit = Reddit(check_for_updates=False, user_agent=AGENT)
+    submission = reddit.submission(id=submission_id)
+    checkpoint_file = filename + '.checkpoint'
+    if os.path.exists(checkpoint_file):
+        seen, pending = load_checkpoint(filename, checkpoint_file, reddit,
+                                        submission)
+        logger.info('Resuming after %d comments, %d MoreComments pending',
+                    len(seen), len(pending))
+    else:
+        seen, pending = set(), None
+        with open(filename, 'w', newline='', encoding='utf8') as fileout:
+            csv.writer(fileout, dialect=CustomDialect).writerow(CSV_HEADER)
+
+    with open(filename, 'a', newline='', encoding='utf8') as fileout:
+        writer = csv.writer(fileout, dialect=CustomDialect)
+        for comments, pending in expand_comments(submission, pending):
+            for comment in comments:
+                if comment.id in seen:
+                    continue
+                seen.add(comment.id)
+                writer.writerow(csv_row(comment))
+            fileout.flush()
+            os.fsync(fileout.fileno())
+            save_checkpoint(checkpoint_file,
+                            os.fstat(fileout.fileno()).st_size, pending)
+            logger.debug('Written %d comments, %d MoreComments pending',
+                         len(seen), len(pending))
+    os.remove(checkpoint_file)
+    return len(seen)
+
+
 def main():
     """Provide the entry point to the command."""
     parser = arg_parser(usage='usage: %(prog)s t3 COMMAND [filename]')
     parser.add_argument(
-        't3', type=str, help='The id of the source thread (es: 5npcrc)')
+        't3',
+        type=str,
+        help='The id of the source thread (es: 5npcrc), '
+        'with --batch a file of ids or - for stdin')
     parser.add_argument(
-        'command', type=str, help='text (body to txt) or csv (all to csv)')
+        'command',
+        type=str,
+        choices=sorted(DEFAULT_FILENAMES),
+        help='text (body to txt), csv (all to csv) or cloud '
+        '(most frequent terms to csv, or json by filename)')
     parser.add_argument(
         'filename',
         type=str,
@@ -80,6 +418,36 @@ def main():
         type=int,
         default=0,
         help='0 for disabled, 1 for info, more for debug')
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='csv only: write while expanding, resume if interrupted')
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='Export every thread listed in t3, in one file if filename '
+        'is given, otherwise one file each')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Threads expanded at the same time with --batch')
+    parser.add_argument(
+        '--top',
+        type=int,
+        default=200,
+        help='cloud only: number of terms in the output')
+    parser.add_argument(
+        '--ngrams',
+        type=int,
+        default=1,
+        help='cloud only: count also sequences of up to this many words')
+    parser.add_argument(
+        '--stopwords',
+        type=str,
+        default='',
+        help='cloud only: comma separated stopword lists to skip (%s)' %
+        ','.join(sorted(STOPWORDS)))
 
     options = parser.parse_args()
 
@@ -91,18 +459,45 @@ def main():
         logger.setLevel(logging.NOTSET)
     logger.addHandler(logging.StreamHandler())
 
-    comments = get_comments(options.t3)
+    if options.top < 1:
+        parser.error('--top must be at least 1')
+
+    stopwords = set()
+    for language in filter(None, options.stopwords.split(',')):
+        if language not in STOPWORDS:
+            parser.error('Unknown stopwords: %s' % language)
+        stopwords.update(STOPWORDS[language])
 
-    default_filename = 'output'
-    if options.command == 'text':
-        output = '\n'.join(extract_bodies(comments))
-        default_filename = '%s.txt'
-    elif options.command == 'csv':
-        default_filename = '%s.csv'
-        output = to_csv(comments)
+    if options.batch:
+        if options.stream:
+            parser.error('--stream is not available with --batch')
+        export_batch(read_ids(options.t3), options.command, options.filename,
+                     options.workers,
+                     (options.top, stopwords, options.ngrams))
+        return 0
+
+    if options.command == 'cloud':
+        counter = stream_cloud(options.t3, TermCounter(options.top),
+                               stopwords, options.ngrams)
+        write_cloud(counter, options.filename or
+                    DEFAULT_FILENAMES['cloud'] % options.t3)
+        return 0
+
+    if options.stream:
+        if options.command != 'csv':
+            parser.error('--stream is available only for csv')
+        try:
+            stream_csv(options.t3, options.filename or '%s.csv' % options.t3)
+        except KeyboardInterrupt:
+            logger.warning('Interrupted, run again to resume')
+            return 1
+        return 0
+
+    comments = get_comments(options.t3)
+    output = render(options.command, comments)
 
     if not options.filename:
-        options.filename = default_filename % options.t3
+        options.filename = DEFAULT_FILENAMES[options.command] % options.t3
 
     with open(options.filename, 'w', encoding='utf8') as fileout:
         fileout.write(output)
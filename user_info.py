@@ -1,7 +1,14 @@
 """Add user info to csv"""
 import csv
+import json
 import logging
+import os
+import sqlite3
+import threading
+import time
 from argparse import ArgumentParser as arg_parser
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 import prawcore
 import praw
@@ -10,6 +17,12 @@ AGENT = 'python:users_dump:0.1 (by /u/timendum)'
 
 LOGGER = logging.getLogger(__file__)
 
+CACHE_DB = 'reddit.db'
+DAY_SECONDS = 24 * 60 * 60
+# Rows written between two checkpoints
+CHUNK = 100
+NOT_FOUND = ['n/a', 'n/a', 'n/a', 'n/a']
+
 
 class CustomDialect(csv.Dialect):
     """Describe the usual properties of Excel-generated CSV files."""
@@ -21,32 +34,125 @@ class CustomDialect(csv.Dialect):
     quoting = csv.QUOTE_MINIMAL
 
 
-def process(filename: str):
-    """Read users and add info to the csv"""
-    lines = None
-    with open(filename, 'r', newline='', encoding='utf-8') as filehanlder:
-        rcsv = csv.reader(filehanlder, CustomDialect)
-        lines = [l for l in rcsv]
-        session = praw.Reddit()
-        for line in lines:
-            try:
-                user = session.redditor(line[0])
-                line.append(user.created_utc)
-                line.append(user.comment_karma)
-                line.append(user.link_karma)
-                line.append(user.has_verified_email)
-            except prawcore.exceptions.NotFound:
-                line.append('n/a')
-                line.append('n/a')
-                line.append('n/a')
-                line.append('n/a')
-
-    with open(filename, 'w', newline='', encoding='utf-8') as filehanlder:
-        wcsv = csv.writer(filehanlder, CustomDialect)
-        wcsv.writerow(
-            ['Username', 'Created UTC', 'Comment karma', 'Link karma', 'Has verified email'])
-        for line in lines:
-            wcsv.writerow(line)
+def open_cache() -> sqlite3.Connection:
+    """Open the user cache"""
+    con = sqlite3.connect(CACHE_DB)
+    con.execute(
+        """CREATE TABLE IF NOT EXISTS user_info (
+        username VARCHAR(100) NOT NULL,
+        created_utc REAL,
+        comment_karma INTEGER,
+        link_karma INTEGER,
+        has_verified_email BOOLEAN,
+        found BOOLEAN NOT NULL,
+        fetched_at INTEGER NOT NULL,
+        PRIMARY KEY (username)
+        )""")
+    con.commit()
+    return con
+
+
+def cached_users(con: sqlite3.Connection, names, ttl: int) -> dict:
+    """Return the info of the users cached less than ttl seconds ago"""
+    infos = {}
+    for name in names:
+        row = con.execute(
+            """SELECT created_utc, comment_karma, link_karma, has_verified_email, found
+            FROM user_info WHERE username = ? AND fetched_at > ?""",
+            (name.lower(), time.time() - ttl)).fetchone()
+        if row:
+            infos[name] = [row[0], row[1], row[2], bool(row[3])] if row[4] else None
+    return infos
+
+
+def fetch_user(session: praw.Reddit, name: str):
+    """Return the info of a user, None if not found"""
+    try:
+        user = session.redditor(name)
+        return [user.created_utc, user.comment_karma, user.link_karma,
+                user.has_verified_email]
+    except prawcore.exceptions.NotFound:
+        return None
+
+
+def save_checkpoint(checkpoint: str, rows: int, offset: int):
+    """Atomically write the number of rows done and the output size"""
+    with open(checkpoint + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'rows': rows, 'offset': offset}, f)
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+
+def process(filename: str, ttl: int = 7 * DAY_SECONDS, workers: int = 4):
+    """Read users and add info to the csv
+
+    Every user is looked up once, from the cache when possible, otherwise
+    concurrently. Rows go to a partial file, checkpointed every CHUNK rows,
+    that replaces the input at the end: an interrupted run resumes.
+    """
+    partial = filename + '.partial'
+    checkpoint = filename + '.checkpoint'
+    done = 0
+    if os.path.exists(checkpoint) and not os.path.exists(partial):
+        # left by an older run, after the partial file replaced the input
+        LOGGER.warning('Ignoring %s without %s', checkpoint, partial)
+        os.remove(checkpoint)
+    if os.path.exists(checkpoint):
+        with open(checkpoint, encoding='utf-8') as f:
+            state = json.load(f)
+        done = state['rows']
+        with open(partial, 'r+b') as f:
+            f.truncate(state['offset'])
+        LOGGER.info('Resuming after %d rows', done)
+    else:
+        with open(partial, 'w', newline='', encoding='utf-8') as filehanlder:
+            wcsv = csv.writer(filehanlder, CustomDialect)
+            wcsv.writerow(
+                ['Username', 'Created UTC', 'Comment karma', 'Link karma', 'Has verified email'])
+
+    con = open_cache()
+    # a session for each worker, praw is not thread-safe
+    local = threading.local()
+
+    def fetch(name):
+        if not hasattr(local, 'session'):
+            local.session = praw.Reddit()
+        return fetch_user(local.session, name)
+
+    with open(filename, 'r', newline='', encoding='utf-8') as filehanlder, \
+            open(partial, 'a', newline='', encoding='utf-8') as fileout, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        rcsv = islice(csv.reader(filehanlder, CustomDialect), done, None)
+        wcsv = csv.writer(fileout, CustomDialect)
+        while True:
+            lines = list(islice(rcsv, CHUNK))
+            if not lines:
+                break
+            names = {line[0] for line in lines if line}
+            infos = cached_users(con, names, ttl)
+            missing = [name for name in names if name not in infos]
+            for name, info in zip(missing,
+                                  executor.map(fetch, missing)):
+                infos[name] = info
+                con.execute(
+                    """INSERT OR REPLACE INTO user_info (username, created_utc, comment_karma,
+                    link_karma, has_verified_email, found, fetched_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    [name.lower()] + (info or [None] * 4) + [info is not None, time.time()])
+            con.commit()
+            for line in lines:
+                if line:
+                    line.extend(infos[line[0]] or NOT_FOUND)
+                wcsv.writerow(line)
+            fileout.flush()
+            os.fsync(fileout.fileno())
+            done += len(lines)
+            save_checkpoint(checkpoint, done, os.fstat(fileout.fileno()).st_size)
+            LOGGER.info('Processed %d rows (%d fetched)', done, len(missing))
+
+    # without checkpoint an interruption here only restarts from the input
+    os.remove(checkpoint)
+    os.replace(partial, filename)
+    con.close()
 
 
 def main():
@@ -55,6 +161,10 @@ def main():
     parser.add_argument('filename', type=str, help='The file with the list of usernames')
     parser.add_argument(
         '--verbose', type=int, default=0, help='0 for disabled, 1 for info, more for debug')
+    parser.add_argument(
+        '--ttl', type=int, default=7, help='Days a cached user is valid')
+    parser.add_argument(
+        '--workers', type=int, default=4, help='Users fetched at the same time')
     options = parser.parse_args()
 
     if options.verbose == 1:
@@ -64,7 +174,7 @@ def main():
     else:
         LOGGER.setLevel(logging.NOTSET)
     LOGGER.addHandler(logging.StreamHandler())
-    process(options.filename)
+    process(options.filename, options.ttl * DAY_SECONDS, options.workers)
 
 
 if __name__ == "__main__":
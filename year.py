@@ -1,12 +1,21 @@
 """Fetch submission from Pushshift, refresh data from Reddit and save to CSV"""
 import csv
+import json
+import os
+import time
 from datetime import datetime
+from itertools import islice
 
 import praw
 from psaw import PushshiftAPI
 
 DELTA_YEAR = 0  # 0 = current, 1 = past
 
+# Max number of fullnames in a /api/info request
+INFO_CHUNK = 100
+# Tries of a /api/info request before stopping at the last checkpoint
+INFO_ATTEMPTS = 3
+
 ATTRS = [
     "id",
     "score",
@@ -27,50 +36,118 @@ ATTRS = [
 ]
 
 
+def save_checkpoint(checkpoint, before, boundary, offset):
+    """Atomically write the cursor, the ids at the cursor and the output size"""
+    with open(checkpoint + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"before": before, "boundary": sorted(boundary), "offset": offset}, f)
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+
+def scan_csv(filename):
+    """Return the oldest created_utc of a csv without checkpoint and its ids"""
+    before = None
+    boundary = set()
+    with open(filename, "r", newline="", encoding="utf-8") as filecsv:
+        reader = csv.reader(filecsv)
+        next(reader, None)
+        for row in reader:
+            created_utc = int(float(row[4]))
+            if before is None or created_utc < before:
+                before = created_utc
+                boundary = set()
+            if created_utc == before:
+                boundary.add(row[0])
+    return before, boundary, os.path.getsize(filename)
+
+
+def fetch_info(reddit, batch):
+    """Return the rows of the batch found by Reddit, retrying a failed request"""
+    for attempt in range(INFO_ATTEMPTS):
+        try:
+            return [
+                [getattr(rs, attr) for attr in ATTRS]
+                for rs in reddit.info(fullnames=["t3_" + ps.id for ps in batch])
+            ]
+        except Exception as e:
+            print("Error with", batch[0].id, "-", batch[-1].id, e)
+            if attempt + 1 == INFO_ATTEMPTS:
+                raise
+            time.sleep(2**attempt)
+
+
 def main():
+    now = datetime.now()
 
     after = int((datetime(now.year - DELTA_YEAR, 1, 1) - datetime(1970, 1, 1)).total_seconds())
     before = int((datetime(now.year + 1 - DELTA_YEAR, 1, 1) - datetime(1970, 1, 1)).total_seconds())
 
     filename = f"year-{now.year - DELTA_YEAR}.csv"
+    checkpoint = filename + ".checkpoint"
 
     reddit = praw.Reddit(disable_update_check=True)
     api = PushshiftAPI()
 
-    processed_ids = set()
-    try:
-        with open(filename, "r", newline="", encoding="utf-8") as filecsv:
-            reader = csv.reader(filecsv)
-            rows = list(reader)
-        processed_ids = {row[0] for row in rows}
-        after = int(min([float(row[4]) for row in rows[1:]]))
-        print("Continuing after:", after)
-    except FileNotFoundError:
+    # ids already written with created_utc == before
+    boundary = set()
+    if os.path.exists(checkpoint):
+        with open(checkpoint, encoding="utf-8") as f:
+            state = json.load(f)
+        before, boundary, offset = state["before"], set(state["boundary"]), state["offset"]
+        # drop rows written after the last checkpoint
+        with open(filename, "r+b") as filecsv:
+            filecsv.truncate(offset)
+        print("Continuing before:", before)
+    elif os.path.exists(filename):
+        oldest, boundary, offset = scan_csv(filename)
+        if oldest is not None:
+            before = oldest
+        save_checkpoint(checkpoint, before, boundary, offset)
+        print("Continuing before:", before)
+    else:
         with open(filename, "w", newline="", encoding="utf-8") as filecsv:
             writer = csv.writer(filecsv)
             writer.writerow(ATTRS)
 
+    # newest first, before is exclusive: include the boundary second
     submissions = api.search_submissions(
-        limit=1000000, subreddit="italy", after=after, before=before
+        limit=1000000, subreddit="italy", after=after, before=before + 1, sort="desc"
     )
-    
-    errors = []
+
+    # not returned by info, deleted or private
+    missing = []
     with open(filename, "a", newline="", encoding="utf-8") as filecsv:
         writer = csv.writer(filecsv)
         try:
-            for ps in submissions:
-                if ps.id in processed_ids:
+            while True:
+                batch = list(islice(submissions, INFO_CHUNK))
+                if not batch:
+                    break
+                batch = [ps for ps in batch if ps.id not in boundary]
+                if not batch:
                     print("-", end="", flush=True)
                     continue
                 try:
-                    rs = reddit.submission(ps.id)
-                    writer.writerow([getattr(rs, attr) for attr in ATTRS])
-                    print(".", end="", flush=True)
-                except Exception as e:
-                    errors.append(ps.id)
-                    print("Error with", ps.id, e)
+                    rows = fetch_info(reddit, batch)
+                except Exception:
+                    # the checkpoint stays before this batch, a rerun retries it
+                    print("Stopped before", batch[0].id, "- rerun to retry from the checkpoint")
+                    break
+                writer.writerows(rows)
+                found = {row[0] for row in rows}
+                missing.extend(ps.id for ps in batch if ps.id not in found)
+                print(".", end="", flush=True)
+                oldest = int(min(ps.created_utc for ps in batch))
+                if oldest < before:
+                    before = oldest
+                    boundary = set()
+                boundary.update(ps.id for ps in batch if int(ps.created_utc) == before)
+                filecsv.flush()
+                os.fsync(filecsv.fileno())
+                save_checkpoint(checkpoint, before, boundary, os.fstat(filecsv.fileno()).st_size)
         except KeyboardInterrupt:
             pass
+    if missing:
+        print("Not found:", len(missing))
 
 
 if __name__ == "__main__":